@@ -1,50 +1,119 @@
 import duckdb
+import hashlib
 import logging
+import math
+import os
+import pickle
 from pathlib import Path
+from statistics import NormalDist
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+import connection
+import instrument
+import result_cache
+
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
     filename='analysis.log'
 )
 logger = logging.getLogger(__name__)
 
-# Paths to CSVs (adjust if needed)
-YELLOW_CSV = Path("dbt/output/yellow_trips.csv")
-GREEN_CSV = Path("dbt/output/green_trips.csv")
+DB_FILE = os.environ.get("DB_FILE", "traffic.duckdb")
+DBT_SCHEMA = "emissions" # Schema the dbt profile builds models into
+
+# dbt trip export for every fleet, without a suffix so either the Parquet file/directory or the CSV is picked up
+TRIPS_OUTPUT = Path("dbt/output/trips")
+FLEETS = ("yellow", "green")
 OUTPUT_PLOT = Path("dbt/output/co2_by_month.png")
 
+# Only the columns the analysis aggregates are read
+ANALYSIS_COLUMNS = ["pickup_datetime", "dropoff_datetime", "trip_distance", "trip_co2_kgs",
+                    "duration_minutes", "hour_of_day", "day_of_week", "week_of_year", "month_of_year"]
+
+# Columns analyze_one reports the average trip CO2 for
+GROUP_COLUMNS = ["hour_of_day", "day_of_week", "week_of_year", "month_of_year"]
+
+# "rollup" reads the pre-aggregated co2_rollup dbt model, "duckdb" aggregates the trip export
+# in SQL so only summary rows reach Python, "pandas" loads every trip, "streaming" folds trips
+# into running totals chunk by chunk for hosts with little RAM, "sample" gives approximate
+# answers with confidence intervals from the trips_sample dbt model. The exact engines sum in
+# different orders, so their means and totals can differ in the last bit or two (relative
+# difference below 1e-12), the largest trip is the same row.
+ANALYSIS_ENGINE = os.environ.get("ANALYSIS_ENGINE", "rollup")
+SAMPLE_CONFIDENCE = float(os.environ.get("SAMPLE_CONFIDENCE", 0.95)) # Coverage of the intervals the sample engine reports
+# Aggregates and the plot are cached on disk, keyed by the input fingerprint and code version
+CACHE_ENABLED = os.environ.get("ANALYSIS_CACHE", "1") == "1"
+CACHE_DIR = Path("dbt/output/.analysis_cache")
+CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+CACHE_MAX_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_MAX_ENTRIES", 20))
+STREAM_CHUNK_VECTORS = int(os.environ.get("STREAM_CHUNK_VECTORS", 64)) # 64 * 2048 rows per chunk
+
 # Helper mapping from DuckDB dayofweek (Sunday=0) to names
 DAYNAME = {0: "Sunday", 1: "Monday", 2: "Tuesday", 3: "Wednesday",
            4: "Thursday", 5: "Friday", 6: "Saturday"}
 
-def load_and_clean(path):
-    logger.info("""Loading CSV into a DataFrame and performing basic cleaning / dtype fixes.""")
-    df = pd.read_csv(path, parse_dates=["pickup_datetime", "dropoff_datetime"])
-
-    # Ensure expected columns exist
-    expected = {"pickup_datetime", "dropoff_datetime", "trip_distance", "trip_co2_kgs",
-                "duration_minutes", "avg_mph", "hour_of_day", "day_of_week", "week_of_year", "month_of_year"}
-    missing = expected - set(df.columns)
-    if missing:
-        raise ValueError(f"Missing expected columns in {path}: {missing}")
-
-    # Coerce numeric types
-    df["trip_distance"] = pd.to_numeric(df["trip_distance"], errors="coerce")
-    df["trip_co2_kgs"] = pd.to_numeric(df["trip_co2_kgs"], errors="coerce")
-    df["duration_minutes"] = pd.to_numeric(df["duration_minutes"], errors="coerce")
-    df["hour_of_day"] = pd.to_numeric(df["hour_of_day"], errors="coerce").astype("Int64")
-    df["day_of_week"] = pd.to_numeric(df["day_of_week"], errors="coerce").astype("Int64")
-    df["week_of_year"] = pd.to_numeric(df["week_of_year"], errors="coerce").astype("Int64")
-    df["month_of_year"] = pd.to_numeric(df["month_of_year"], errors="coerce").astype("Int64")
-
-    # Drop rows missing essential values
-    df = df.dropna(subset=["pickup_datetime", "dropoff_datetime", "trip_distance", "trip_co2_kgs"])
-
-    # Filter out non-positive distances or durations (as per model filtering, but safeguard)
-    df = df[(df["trip_distance"] > 0) & (df["duration_minutes"] > 0) & (df["trip_co2_kgs"] >= 0)]
+def _written_at(path):
+    # A partitioned export is a directory, its newest file says when dbt last wrote it
+    if path.is_dir():
+        return max((f.stat().st_mtime_ns for f in path.rglob("*.parquet")), default=0)
+    return path.stat().st_mtime_ns
+
+def resolve_trips_path(base=TRIPS_OUTPUT):
+    """Finds the newest dbt trip export: Parquet file, partitioned Parquet directory, or CSV.
+
+    dbt only writes the format its vars ask for, so an export in another format left over from
+    an earlier run is older and is ignored.
+    """
+    candidates = [c for c in (base.with_suffix(".parquet"), base, base.with_suffix(".csv")) if c.exists()]
+    if not candidates:
+        raise FileNotFoundError(f"{base}.parquet/.csv not found. Run dbt to generate the trip output first.")
+    return max(candidates, key=_written_at)
+
+def read_trips(path, fleet, columns=ANALYSIS_COLUMNS):
+    if path.suffix == ".csv":
+        df = pd.read_csv(path, usecols=lambda c: c in columns or c == "fleet", float_precision="round_trip",
+                         parse_dates=["pickup_datetime", "dropoff_datetime"])
+        df = df[df["fleet"] == fleet].drop(columns="fleet")
+        # CSV loses types, so coerce numerics the way the old text path did
+        for col in ("trip_distance", "trip_co2_kgs", "duration_minutes"):
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors="coerce")
+        for col in ("hour_of_day", "day_of_week", "week_of_year", "month_of_year"):
+            if col in df.columns:
+                df[col] = pd.to_numeric(df[col], errors="coerce").astype("Int64")
+        return df
+
+    # Parquet already carries the right types, DuckDB reads just the projected columns
+    source = path / "**" / "*.parquet" if path.is_dir() else path
+    select = ", ".join(columns)
+    with connection.connect() as con:
+        return instrument.execute(
+            con,
+            f"SELECT {select} FROM read_parquet('{source.as_posix()}', hive_partitioning = true) WHERE fleet = ?",
+            [fleet],
+            fetch="df",
+        )
+
+def load_and_clean(path, fleet):
+    logger.info("""Loading trips into a DataFrame and performing basic cleaning.""")
+    with instrument.span('read_trips', target=fleet) as s:
+        df = read_trips(path, fleet)
+        s['rows_in'] = len(df)
+
+        # Ensure expected columns exist
+        expected = set(ANALYSIS_COLUMNS)
+        missing = expected - set(df.columns)
+        if missing:
+            raise ValueError(f"Missing expected columns in {path}: {missing}")
+
+        # Drop rows missing essential values
+        df = df.dropna(subset=["pickup_datetime", "dropoff_datetime", "trip_distance", "trip_co2_kgs"])
+
+        # Filter out non-positive distances or durations (as per model filtering, but safeguard)
+        df = df[(df["trip_distance"] > 0) & (df["duration_minutes"] > 0) & (df["trip_co2_kgs"] >= 0)]
+        s['rows_out'] = len(df)
     logger.info("Complete")
     return df
 
@@ -67,66 +136,312 @@ def print_extreme(series, label, value_formatter=lambda v: f"{v:.3f}"):
     bottom_idx = series.idxmin()
     logger.info(f"  {label} — Highest: {top_idx} ({value_formatter(series.loc[top_idx])}), Lowest: {bottom_idx} ({value_formatter(series.loc[bottom_idx])})")
 
-def analyze_one(df, label):
+def summarize_frame(df):
+    logger.info("""Computing every reported aggregate from an in-memory DataFrame.""")
+    summary = {col: avg_by_group(df, col) for col in GROUP_COLUMNS}
+    summary["largest"] = largest_trip(df)
+    summary["monthly_totals"] = df.groupby("month_of_year")["trip_co2_kgs"].sum().reindex(range(1,13), fill_value=0)
+    return summary
+
+def trips_source(path, fleet):
+    """SQL relation over one fleet of the dbt output, with the same row filters as load_and_clean."""
+    if fleet not in FLEETS:
+        raise ValueError(f"Unknown fleet: {fleet}")
+    if path.suffix == ".csv":
+        relation = f"read_csv('{path.as_posix()}', header = true)"
+    else:
+        source = path / "**" / "*.parquet" if path.is_dir() else path
+        relation = f"read_parquet('{source.as_posix()}', hive_partitioning = true)"
+    return f"""(
+        SELECT {", ".join(ANALYSIS_COLUMNS)}
+        FROM {relation}
+        WHERE fleet = '{fleet}'
+          AND pickup_datetime IS NOT NULL AND dropoff_datetime IS NOT NULL
+          AND trip_distance > 0 AND duration_minutes > 0 AND trip_co2_kgs >= 0
+    )"""
+
+def _grouping_sets(within=(), grand_total=False):
+    """SELECT items naming each row's grouping set and key, and the matching GROUP BY clause.
+
+    Each column of GROUP_COLUMNS is its own grouping set, nested in the within columns.
+    With grand_total the whole input is one more set, labelled 'all'.
+    """
+    cases = [f"                WHEN GROUPING({col}) = 0 THEN '{col}'" for col in GROUP_COLUMNS]
+    if grand_total:
+        cases.append("                ELSE 'all'")
+    case_lines = "\n".join(cases)
+    select = f"""CASE
+{case_lines}
+            END AS group_col,
+            COALESCE({", ".join(GROUP_COLUMNS)}) AS group_key"""
+    sets = [f"({', '.join([*within, col])})" for col in GROUP_COLUMNS] + (["()"] if grand_total else [])
+    return select, f"GROUP BY GROUPING SETS ({', '.join(sets)})"
+
+def _groups(rows):
+    """(column, its rows) for each column of GROUP_COLUMNS in a _grouping_sets result."""
+    for col in GROUP_COLUMNS:
+        yield col, rows[(rows["group_col"] == col) & rows["group_key"].notna()]
+
+def _group_summary(rows):
+    """Average trip CO2 per group from avg_co2 and monthly totals from total_co2."""
+    summary = {}
+    for col, group in _groups(rows):
+        index = group["group_key"].astype(int).values
+        summary[col] = pd.Series(group["avg_co2"].values, index=index, name="trip_co2_kgs").sort_index()
+        if col == "month_of_year":
+            summary["monthly_totals"] = pd.Series(group["total_co2"].values, index=index).reindex(range(1,13), fill_value=0)
+    return summary
+
+def summarize_duckdb(path, fleet):
+    logger.info("""Computing every reported aggregate in one DuckDB GROUPING SETS query.""")
+    grouping, group_by = _grouping_sets(grand_total=True)
+    largest_fields = ", ".join(f"'{col}': {col}" for col in ANALYSIS_COLUMNS)
+    with connection.connect() as con:
+        rows = instrument.execute(con, f"""
+            SELECT
+                {grouping},
+                AVG(trip_co2_kgs) AS avg_co2,
+                SUM(trip_co2_kgs) AS total_co2,
+                arg_max({{{largest_fields}}}, trip_co2_kgs) AS largest
+            FROM {trips_source(path, fleet)}
+            {group_by}
+        """, fetch="df")
+
+    summary = _group_summary(rows)
+    summary["largest"] = pd.Series(rows.loc[rows["group_col"] == "all", "largest"].iloc[0])
+    logger.info("Complete")
+    return summary
+
+def summarize_streaming(path, fleet, chunk_vectors=STREAM_CHUNK_VECTORS):
+    logger.info("""Computing every reported aggregate from streamed chunks with constant memory.""")
+    with connection.connect() as con:
+        # Streaming result: DuckDB hands back chunk_vectors * 2048 rows at a time, in file order
+        result = con.execute(f"SELECT * FROM {trips_source(path, fleet)}")
+
+        partials = {col: [] for col in GROUP_COLUMNS}
+        running = {col: None for col in GROUP_COLUMNS}
+        largest = None
+        while True:
+            chunk = result.fetch_df_chunk(chunk_vectors)
+            if chunk.empty:
+                break
+            for col in GROUP_COLUMNS:
+                stats = chunk.groupby(col)["trip_co2_kgs"].agg(["sum", "count"])
+                partials[col].append(stats["sum"])
+                counts = stats["count"]
+                running[col] = counts if running[col] is None else running[col].add(counts, fill_value=0)
+                # Keep the per-chunk sums bounded by folding them once there are many
+                if len(partials[col]) >= 256:
+                    partials[col] = [_exact_sum(partials[col])]
+            # Strict > keeps the first occurrence on ties, same as idxmax over the whole frame
+            idx = chunk["trip_co2_kgs"].idxmax()
+            if largest is None or chunk.at[idx, "trip_co2_kgs"] > largest["trip_co2_kgs"]:
+                largest = chunk.loc[idx].copy()
+
+    # fsum gives the correctly rounded sum, pandas' groupby adds with Kahan compensation in row
+    # order, so means and totals agree with summarize_frame to a few ULP rather than bit for bit
+    summary = {}
+    for col in GROUP_COLUMNS:
+        sums = _exact_sum(partials[col])
+        summary[col] = (sums / running[col]).sort_index().rename("trip_co2_kgs")
+        summary[col].index = summary[col].index.astype(int)
+        if col == "month_of_year":
+            sums.index = sums.index.astype(int)
+            summary["monthly_totals"] = sums.reindex(range(1,13), fill_value=0)
+    summary["largest"] = largest
+    logger.info("Complete")
+    return summary
+
+def _exact_sum(series_list):
+    """Adds per-chunk group sums with math.fsum so chunking doesn't add rounding error."""
+    frame = pd.concat(series_list, axis=1)
+    return frame.apply(lambda row: math.fsum(row.dropna()), axis=1)
+
+def summarize_rollup(fleet, db_file=DB_FILE):
+    logger.info("""Computing every reported aggregate from the co2_rollup model.""")
+    con = connection.connect(db_file, read_only=True)
+    try:
+        grouping, group_by = _grouping_sets()
+        # Averages are re-derived from sums and counts so they equal the per-trip mean
+        rows = instrument.execute(con, f"""
+            SELECT
+                {grouping},
+                SUM(co2_sum_kgs) / SUM(trip_count) AS avg_co2,
+                SUM(co2_sum_kgs) AS total_co2
+            FROM {DBT_SCHEMA}.co2_rollup
+            WHERE fleet = ?
+            {group_by}
+        """, [fleet], fetch="df")
+        summary = _group_summary(rows)
+
+        # The rollup keeps the max per month, so only that month of trips is read for the full row
+        largest = instrument.execute(con, f"""
+            SELECT {", ".join(ANALYSIS_COLUMNS)}
+            FROM {DBT_SCHEMA}.trips
+            WHERE fleet = ?
+              AND pickup_month = (
+                SELECT pickup_month FROM {DBT_SCHEMA}.co2_rollup
+                WHERE fleet = ? ORDER BY co2_max_kgs DESC LIMIT 1
+              )
+            ORDER BY trip_co2_kgs DESC
+            LIMIT 1
+        """, [fleet, fleet], fetch="df")
+        summary["largest"] = largest.iloc[0]
+    finally:
+        con.close()
+    logger.info("Complete")
+    return summary
+
+def _stratified_estimates(cells, strata, z):
+    """Domain means and totals with interval half-widths from per-stratum sample sums.
+
+    cells has one row per stratum and group key (n, sum_y, sum_y2), strata the population and
+    sample size of each stratum. Totals use the stratified expansion estimator, means the ratio
+    of estimated total to estimated count, with variances from the usual Taylor linearisation.
+    """
+    c = cells.merge(strata, on="pickup_month")
+    N, n = c["stratum_rows"], c["stratum_sample"]
+    # N^2 (1 - n/N) / (n (n - 1)), zero for strata that were kept in full
+    factor = N**2 * (1 - n / N) / n / (n - 1).clip(lower=1)
+    c["total"] = N / n * c["sum_y"]
+    c["count"] = N / n * c["n"]
+    estimates = c.groupby("group_key")[["total", "count"]].sum()
+    ratio = estimates["total"] / estimates["count"]
+    r = c["group_key"].map(ratio)
+    c["var_total"] = factor * (c["sum_y2"] - c["sum_y"]**2 / n)
+    c["var_mean"] = factor * ((c["sum_y2"] - 2 * r * c["sum_y"] + r**2 * c["n"])
+                              - (c["sum_y"] - r * c["n"])**2 / n) / c["group_key"].map(estimates["count"])**2
+    variances = c.groupby("group_key")[["var_total", "var_mean"]].sum().clip(lower=0)
+    index = estimates.index.astype(int)
+    return (pd.Series(ratio.values, index=index), pd.Series(z * np.sqrt(variances["var_mean"].values), index=index),
+            pd.Series(estimates["total"].values, index=index), pd.Series(z * np.sqrt(variances["var_total"].values), index=index))
+
+def summarize_sample(fleet, db_file=DB_FILE, confidence=SAMPLE_CONFIDENCE):
+    logger.info("""Estimating every reported aggregate from the trips_sample model.""")
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    con = connection.connect(db_file, read_only=True)
+    try:
+        # Sums and sums of squares per stratum and group key are all the estimators need
+        grouping, group_by = _grouping_sets(within=["pickup_month"])
+        cells = instrument.execute(con, f"""
+            SELECT
+                {grouping},
+                pickup_month,
+                COUNT(*) AS n,
+                SUM(trip_co2_kgs) AS sum_y,
+                SUM(trip_co2_kgs * trip_co2_kgs) AS sum_y2
+            FROM {DBT_SCHEMA}.trips_sample
+            WHERE fleet = ?
+            {group_by}
+        """, [fleet], fetch="df")
+        strata = instrument.execute(con, f"""
+            SELECT pickup_month, ANY_VALUE(stratum_rows) AS stratum_rows, COUNT(*) AS stratum_sample
+            FROM {DBT_SCHEMA}.trips_sample
+            WHERE fleet = ?
+            GROUP BY pickup_month
+        """, [fleet], fetch="df")
+        largest = instrument.execute(con, f"""
+            SELECT {", ".join(ANALYSIS_COLUMNS)}
+            FROM {DBT_SCHEMA}.trips_sample
+            WHERE fleet = ?
+            ORDER BY trip_co2_kgs DESC
+            LIMIT 1
+        """, [fleet], fetch="df")
+    finally:
+        con.close()
+    if strata.empty:
+        raise ValueError(f"trips_sample has no {fleet} trips")
+
+    summary = {"ci": {}}
+    for col, group in _groups(cells):
+        mean, mean_ci, total, total_ci = _stratified_estimates(group, strata, z)
+        summary[col] = mean.sort_index().rename("trip_co2_kgs")
+        summary["ci"][col] = mean_ci.sort_index()
+        if col == "month_of_year":
+            summary["monthly_totals"] = total.reindex(range(1,13), fill_value=0)
+            summary["ci"]["monthly_totals"] = total_ci.reindex(range(1,13), fill_value=0)
+    # Only the sample is read, so this is the largest sampled trip, not necessarily the largest overall
+    summary["largest"] = largest.iloc[0]
+    summary["sample"] = {"confidence": confidence, "sample_rows": int(strata["stratum_sample"].sum()),
+                         "trips": int(strata["stratum_rows"].sum())}
+    logger.info("Complete")
+    return summary
+
+def _ci(summary, col, key):
+    """" ± half-width" for an approximate summary, empty for an exact one."""
+    if "ci" not in summary:
+        return ""
+    return f" ± {summary['ci'][col].loc[key]:.6f}"
+
+def analyze_one(data, label):
     logger.info(f"\n=== Analysis for {label} trips ===")
+    # Accept either raw trips or a summary already computed by summarize_duckdb
+    summary = summarize_frame(data) if isinstance(data, pd.DataFrame) else data
+    if "sample" in summary:
+        sample = summary["sample"]
+        logger.info(f"APPROXIMATE: estimated from {sample['sample_rows']} of {sample['trips']} trips, "
+                    f"± values are {sample['confidence']:.0%} confidence intervals")
+
     # Largest trip
-    largest = largest_trip(df)
-    logger.info("Single largest carbon-producing trip (by trip_co2_kgs):")
+    largest = summary["largest"]
+    logger.info("Single largest carbon-producing trip (by trip_co2_kgs)" + (" in the sample:" if "sample" in summary else ":"))
     logger.info(f"  pickup: {largest['pickup_datetime']}")
     logger.info(f"  dropoff: {largest['dropoff_datetime']}")
     logger.info(f"  trip_distance: {largest['trip_distance']}")
     logger.info(f"  trip_co2_kgs: {largest['trip_co2_kgs']:.6f}")
     logger.info(f"  duration_minutes: {largest['duration_minutes']}")
-    logger.info()
+    logger.info("")
 
     # Avg by hour_of_day (0-23)
-    hour_avg = avg_by_group(df, "hour_of_day")
+    hour_avg = summary["hour_of_day"]
     # Convert Int64 index to normal ints for printing
     hour_avg_idx = hour_avg.index.astype(int)
     top_hour = int(hour_avg_idx[hour_avg.argmax()])
     bottom_hour = int(hour_avg_idx[hour_avg.argmin()])
     logger.info("Average trip CO2 per hour of day (0=midnight):")
-    logger.info(f"  Most carbon-heavy hour: {top_hour} (avg CO2 {hour_avg.max():.6f} kg/trip)")
-    logger.info(f"  Least carbon-heavy hour: {bottom_hour} (avg CO2 {hour_avg.min():.6f} kg/trip)")
-    logger.info()
+    logger.info(f"  Most carbon-heavy hour: {top_hour} (avg CO2 {hour_avg.max():.6f}{_ci(summary, 'hour_of_day', top_hour)} kg/trip)")
+    logger.info(f"  Least carbon-heavy hour: {bottom_hour} (avg CO2 {hour_avg.min():.6f}{_ci(summary, 'hour_of_day', bottom_hour)} kg/trip)")
+    logger.info("")
 
     # Avg by day_of_week (DuckDB: Sunday=0)
-    dow_avg = avg_by_group(df, "day_of_week")
+    dow_avg = summary["day_of_week"]
     dow_idx = dow_avg.index.astype(int)
     top_dow = int(dow_idx[dow_avg.argmax()])
     bottom_dow = int(dow_idx[dow_avg.argmin()])
     logger.info("Average trip CO2 per day of week:")
-    logger.info(f"  Most carbon-heavy day: {DAYNAME.get(top_dow, str(top_dow))} (avg CO2 {dow_avg.max():.6f} kg/trip)")
-    logger.info(f"  Least carbon-heavy day: {DAYNAME.get(bottom_dow, str(bottom_dow))} (avg CO2 {dow_avg.min():.6f} kg/trip)")
-    logger.info()
+    logger.info(f"  Most carbon-heavy day: {DAYNAME.get(top_dow, str(top_dow))} (avg CO2 {dow_avg.max():.6f}{_ci(summary, 'day_of_week', top_dow)} kg/trip)")
+    logger.info(f"  Least carbon-heavy day: {DAYNAME.get(bottom_dow, str(bottom_dow))} (avg CO2 {dow_avg.min():.6f}{_ci(summary, 'day_of_week', bottom_dow)} kg/trip)")
+    logger.info("")
 
     # Avg by week_of_year (1-52)
-    week_avg = avg_by_group(df, "week_of_year")
+    week_avg = summary["week_of_year"]
     week_idx = week_avg.index.astype(int)
     top_week = int(week_idx[week_avg.argmax()])
     bottom_week = int(week_idx[week_avg.argmin()])
     logger.info("Average trip CO2 per week of year:")
-    logger.info(f"  Most carbon-heavy week: {top_week} (avg CO2 {week_avg.max():.6f} kg/trip)")
-    logger.info(f"  Least carbon-heavy week: {bottom_week} (avg CO2 {week_avg.min():.6f} kg/trip)")
-    logger.info()
+    logger.info(f"  Most carbon-heavy week: {top_week} (avg CO2 {week_avg.max():.6f}{_ci(summary, 'week_of_year', top_week)} kg/trip)")
+    logger.info(f"  Least carbon-heavy week: {bottom_week} (avg CO2 {week_avg.min():.6f}{_ci(summary, 'week_of_year', bottom_week)} kg/trip)")
+    logger.info("")
 
     # Avg by month_of_year (1-12)
-    month_avg = avg_by_group(df, "month_of_year")
+    month_avg = summary["month_of_year"]
     month_idx = month_avg.index.astype(int)
     top_month = int(month_idx[month_avg.argmax()])
     bottom_month = int(month_idx[month_avg.argmin()])
     import calendar
     logger.info("Average trip CO2 per month:")
-    logger.info(f"  Most carbon-heavy month: {calendar.month_name[top_month]} (avg CO2 {month_avg.max():.6f} kg/trip)")
-    logger.info(f"  Least carbon-heavy month: {calendar.month_name[bottom_month]} (avg CO2 {month_avg.min():.6f} kg/trip)")
-    logger.info()
+    logger.info(f"  Most carbon-heavy month: {calendar.month_name[top_month]} (avg CO2 {month_avg.max():.6f}{_ci(summary, 'month_of_year', top_month)} kg/trip)")
+    logger.info(f"  Least carbon-heavy month: {calendar.month_name[bottom_month]} (avg CO2 {month_avg.min():.6f}{_ci(summary, 'month_of_year', bottom_month)} kg/trip)")
+    logger.info("")
 
     # Return aggregates for plotting: monthly totals
-    monthly_totals = df.groupby("month_of_year")["trip_co2_kgs"].sum().reindex(range(1,13), fill_value=0)
-    return monthly_totals
+    return summary["monthly_totals"]
+
+def plot_monthly(yellow_monthly, green_monthly, out_path, yellow_ci=None, green_ci=None):
+    """Plot MONTH (1..12) vs CO2 totals for yellow and green and save to file.
 
-def plot_monthly(yellow_monthly, green_monthly, out_path):
-    """Plot MONTH (1..12) vs CO2 totals for yellow and green and save to file."""
+    yellow_ci/green_ci are interval half-widths per month for approximate totals, drawn as bands.
+    """
     plt.figure(figsize=(10,6))
     months = np.arange(1,13)
     # If the series index isn't exactly 1..12, reindex
@@ -136,6 +451,10 @@ def plot_monthly(yellow_monthly, green_monthly, out_path):
     # Plot lines
     plt.plot(months, y, marker='o', label='YELLOW total CO2 (kg)')
     plt.plot(months, g, marker='o', label='GREEN total CO2 (kg)')
+    for values, ci in ((y, yellow_ci), (g, green_ci)):
+        if ci is not None:
+            half = ci.reindex(months, fill_value=0).values
+            plt.fill_between(months, values - half, values + half, alpha=0.2)
 
     # X-axis ticks: use month names
     import calendar
@@ -143,7 +462,8 @@ def plot_monthly(yellow_monthly, green_monthly, out_path):
     plt.xticks(months, month_names)
     plt.xlabel("Month")
     plt.ylabel("Total CO2 (kg)")
-    plt.title("Monthly total CO2 from taxi trips — Yellow vs Green")
+    approximate = yellow_ci is not None or green_ci is not None
+    plt.title("Monthly total CO2 from taxi trips — Yellow vs Green" + (" (approximate)" if approximate else ""))
     plt.grid(axis='y', linestyle='--', linewidth=0.5)
     plt.legend()
     plt.tight_layout()
@@ -154,17 +474,134 @@ def plot_monthly(yellow_monthly, green_monthly, out_path):
     plt.close()
     logger.info(f"Saved monthly CO2 plot to: {out_path}")
 
-def main():
-    if not YELLOW_CSV.exists():
-        raise FileNotFoundError(f"{YELLOW_CSV} not found. Run dbt to generate the CSV first.")
-    if not GREEN_CSV.exists():
-        raise FileNotFoundError(f"{GREEN_CSV} not found. Run dbt to generate the CSV first.")
+def summarize(fleet, engine=ANALYSIS_ENGINE):
+    if engine == "sample":
+        try:
+            return summarize_sample(fleet)
+        except (duckdb.Error, ValueError) as e:
+            logger.warning(f"trips_sample unavailable ({e}), computing exact results instead")
+            engine = "rollup"
+
+    if engine == "rollup":
+        try:
+            return summarize_rollup(fleet)
+        except duckdb.Error as e:
+            logger.warning(f"co2_rollup unavailable ({e}), aggregating the trip export instead")
+            engine = "duckdb"
+
+    path = resolve_trips_path()
+    if engine == "pandas":
+        # Loading every trip into pandas is only safe when it fits in this host's budget
+        needed, budget = frame_bytes(path), connection.memory_budget()
+        if needed > budget:
+            logger.warning(f"Trips would need ~{needed / 1024**3:.2f} GB in pandas, over the "
+                           f"{budget / 1024**3:.2f} GB budget, using the streaming engine")
+            return summarize_streaming(path, fleet)
+        return summarize_frame(load_and_clean(path, fleet))
+    if engine == "streaming":
+        return summarize_streaming(path, fleet)
+    return summarize_duckdb(path, fleet)
+
+def frame_bytes(path):
+    """Rough size of the analysis columns as a DataFrame, from the Parquet footers or the CSV size."""
+    if path.suffix == ".csv":
+        return path.stat().st_size
+    source = path / "**" / "*.parquet" if path.is_dir() else path
+    with connection.connect() as con:
+        rows = con.execute(f"SELECT SUM(num_rows) FROM parquet_file_metadata('{source.as_posix()}')").fetchone()[0]
+    # Every analysis column is 8 bytes wide in pandas
+    return (rows or 0) * len(ANALYSIS_COLUMNS) * 8
+
+def input_fingerprint():
+    """Size, mtime and row count of the trip export plus the state of the co2_rollup and trips_sample tables."""
+    fingerprint = {}
+    try:
+        path = resolve_trips_path()
+        files = sorted(path.rglob("*.parquet")) if path.is_dir() else [path]
+        fingerprint["files"] = [(str(f), f.stat().st_size, f.stat().st_mtime_ns) for f in files]
+        if path.suffix != ".csv":
+            source = path / "**" / "*.parquet" if path.is_dir() else path
+            # Parquet footers carry the row count, no data pages are read
+            with connection.connect() as con:
+                fingerprint["rows"] = con.execute(
+                    f"SELECT SUM(num_rows) FROM parquet_file_metadata('{source.as_posix()}')"
+                ).fetchone()[0]
+    except FileNotFoundError:
+        fingerprint["files"] = None
+    try:
+        with connection.connect(DB_FILE, read_only=True) as con:
+            fingerprint["rollup"] = instrument.execute(con, f"""
+                SELECT COUNT(*), SUM(trip_count), MAX(processed_at) FROM {DBT_SCHEMA}.co2_rollup
+            """, fetch="fetchone")
+    except duckdb.Error:
+        fingerprint["rollup"] = None
+    try:
+        # Row count and rates change with the sample_rate/sample_min_rows vars as well as the data
+        with connection.connect(DB_FILE, read_only=True) as con:
+            fingerprint["sample"] = instrument.execute(con, f"""
+                SELECT COUNT(*), SUM(stratum_rows), MIN(sample_rate), MAX(sample_rate)
+                FROM {DBT_SCHEMA}.trips_sample
+            """, fetch="fetchone")
+    except duckdb.Error:
+        fingerprint["sample"] = None
+    return fingerprint
+
+def code_version():
+    # Any edit to this file invalidates cached results
+    return hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
 
-    yellow_df = load_and_clean(YELLOW_CSV)
-    green_df = load_and_clean(GREEN_CSV)
+def compute_results(engine=ANALYSIS_ENGINE):
+    summaries = {}
+    for fleet in FLEETS:
+        with instrument.span('summarize', target=fleet, engine=engine):
+            summaries[fleet] = summarize(fleet, engine)
+    with instrument.span('plot', target=str(OUTPUT_PLOT)):
+        plot_monthly(summaries["yellow"]["monthly_totals"], summaries["green"]["monthly_totals"], OUTPUT_PLOT,
+                     summaries["yellow"].get("ci", {}).get("monthly_totals"),
+                     summaries["green"].get("ci", {}).get("monthly_totals"))
+    return summaries
 
-    yellow_monthly = analyze_one(yellow_df, "YELLOW")
-    green_monthly = analyze_one(green_df, "GREEN")
+def cached_results(engine=ANALYSIS_ENGINE):
+    if not CACHE_ENABLED:
+        return compute_results(engine)
+
+    with instrument.span('cache_lookup') as s:
+        # Interval widths depend on the confidence level, the estimates themselves don't
+        key = result_cache.make_key(input_fingerprint(), code_version(), engine,
+                                    SAMPLE_CONFIDENCE if engine == "sample" else None)
+        hit = result_cache.get(CACHE_DIR, key)
+        s['hit'] = hit is not None
+    if hit is not None:
+        logger.info(f"Using cached analysis results {key[:12]}")
+        OUTPUT_PLOT.parent.mkdir(parents=True, exist_ok=True)
+        OUTPUT_PLOT.write_bytes(hit["plot.png"])
+        return pickle.loads(hit["summaries.pkl"])
+
+    summaries = compute_results(engine)
+    result_cache.put(CACHE_DIR, key, {
+        "summaries.pkl": pickle.dumps(summaries),
+        "plot.png": OUTPUT_PLOT.read_bytes(),
+    }, CACHE_MAX_BYTES, CACHE_MAX_ENTRIES)
+    logger.info(f"Cached analysis results {key[:12]}")
+    return summaries
+
+def record_metrics(db_file=DB_FILE):
+    # Every read above is read-only, metrics go into the database once those connections are closed
+    if not os.path.exists(db_file):
+        logger.info(f"No {db_file}, metrics are only in {instrument.METRICS_FILE}")
+        return
+    try:
+        with connection.connect(db_file) as con:
+            instrument.flush(con)
+    except duckdb.Error as e:
+        logger.warning(f"Could not write metrics to {db_file} ({e}), they are in {instrument.METRICS_FILE}")
+
+def main():
+    instrument.start_run("analysis")
+    with instrument.span('analysis', engine=ANALYSIS_ENGINE):
+        summaries = cached_results()
+    yellow_monthly = analyze_one(summaries["yellow"], "YELLOW")
+    green_monthly = analyze_one(summaries["green"], "GREEN")
 
     logger.info("\n=== Monthly totals (kg CO2) — sample output ===")
     combined = pd.DataFrame({
@@ -172,10 +609,12 @@ def main():
         "yellow_total_kg": yellow_monthly.reindex(range(1,13), fill_value=0).values,
         "green_total_kg": green_monthly.reindex(range(1,13), fill_value=0).values
     })
+    for fleet in FLEETS:
+        if "ci" in summaries[fleet]:
+            combined[f"{fleet}_ci_kg"] = summaries[fleet]["ci"]["monthly_totals"].values
     logger.info(combined)
-
-    # Plot and save
-    plot_monthly(yellow_monthly, green_monthly, OUTPUT_PLOT)
+    logger.info(f"Monthly CO2 plot at: {OUTPUT_PLOT}")
+    record_metrics()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,92 @@
+import argparse
+import duckdb
+import logging
+import os
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+## Synthetic NYC TLC trip files with the raw column layout of the real yellow/green Parquet
+## files, so load.py, clean.py, dbt and analysis.py can be benchmarked without the CDN.
+## Every value is derived from hash(row number, fleet and salt), so output is identical
+## across runs and thread counts, and green trips are not copies of yellow ones. Roughly
+## 2% of rows repeat the previous row exactly, 2% have zero passengers, 1% zero distance,
+## 0.5% are > 100 miles and 0.5% last more than a day.
+
+GREEN_SHARE = 0.1 # Green files get a tenth of the yellow row count, like the real data
+
+
+def _r(color, salt, mod):
+    ## Deterministic pseudo-random integer in [0, mod) for row j of color
+    return f"(hash(j, '{color}:{salt}') % {mod})"
+
+def _trip_columns(color, prefix, year, month):
+    days = 28
+    return f"""
+        TIMESTAMP '{year}-{month:02d}-01' + to_seconds({_r(color, 'pickup', days * 86400)}) AS {prefix}_pickup_datetime,
+        TIMESTAMP '{year}-{month:02d}-01' + to_seconds({_r(color, 'pickup', days * 86400)})
+            + CASE WHEN {_r(color, 'long', 200)} = 0 THEN INTERVAL 30 HOUR
+                   ELSE to_seconds(60 + {_r(color, 'duration', 3600)}) END AS {prefix}_dropoff_datetime,
+        CASE WHEN {_r(color, 'pax', 50)} = 0 THEN 0 ELSE 1 + {_r(color, 'pax_n', 4)} END::BIGINT AS passenger_count,
+        CASE WHEN {_r(color, 'dist', 100)} = 0 THEN 0.0
+             WHEN {_r(color, 'long', 200)} = 1 THEN 150.0 + {_r(color, 'far', 500)}
+             ELSE round(0.1 + {_r(color, 'dist_n', 3000)} / 100.0, 2) END AS trip_distance,
+        (1 + {_r(color, 'rate', 6)})::BIGINT AS RatecodeID,
+        CASE WHEN {_r(color, 'sf', 100)} = 0 THEN 'Y' ELSE 'N' END AS store_and_fwd_flag,
+        (1 + {_r(color, 'pu', 265)})::INTEGER AS PULocationID,
+        (1 + {_r(color, 'do', 265)})::INTEGER AS DOLocationID,
+        ({_r(color, 'pay', 5)})::BIGINT AS payment_type,
+        round(3.0 + {_r(color, 'fare', 6000)} / 100.0, 2) AS fare_amount,
+        1.0::DOUBLE AS extra,
+        0.5::DOUBLE AS mta_tax,
+        round({_r(color, 'tip', 1000)} / 100.0, 2) AS tip_amount,
+        0.0::DOUBLE AS tolls_amount,
+        1.0::DOUBLE AS improvement_surcharge,
+        round(5.5 + {_r(color, 'fare', 6000)} / 100.0 + {_r(color, 'tip', 1000)} / 100.0, 2) AS total_amount,
+        2.5::DOUBLE AS congestion_surcharge"""
+
+def month_query(color, year, month, rows):
+    ## j is the row whose values are used, duplicates point at the previous row
+    rows_cte = f"""
+        SELECT CASE WHEN i > 0 AND hash(i, '{color}:dup') % 50 = 0 THEN i - 1 ELSE i END
+               + {(year * 100 + month) * 1_000_000_000} AS j
+        FROM range({rows}) t(i)"""
+    if color == 'yellow':
+        return f"""
+            SELECT (1 + {_r(color, 'vendor', 2)})::INTEGER AS VendorID,
+                {_trip_columns(color, 'tpep', year, month)},
+                0.0::DOUBLE AS Airport_fee
+            FROM ({rows_cte})"""
+    return f"""
+        SELECT (1 + {_r(color, 'vendor', 2)})::INTEGER AS VendorID,
+            lpep_pickup_datetime, lpep_dropoff_datetime, store_and_fwd_flag, RatecodeID,
+            PULocationID, DOLocationID, passenger_count, trip_distance, fare_amount, extra,
+            mta_tax, tip_amount, tolls_amount, NULL::INTEGER AS ehail_fee, improvement_surcharge,
+            total_amount, payment_type, (1 + {_r(color, 'trip_type', 2)})::BIGINT AS trip_type, congestion_surcharge
+        FROM (SELECT j, {_trip_columns(color, 'lpep', year, month)} FROM ({rows_cte}))"""
+
+def generate(out_dir, total_rows, years, months):
+    os.makedirs(out_dir, exist_ok=True)
+    con = duckdb.connect()
+    periods = [(y, m) for y in years for m in months]
+    per_month = max(1, total_rows // len(periods))
+    written = 0
+    for year, month in periods:
+        for color, rows in (('yellow', per_month), ('green', max(1, int(per_month * GREEN_SHARE)))):
+            path = os.path.join(out_dir, f"{color}_tripdata_{year}-{month:02d}.parquet")
+            con.execute(f"COPY ({month_query(color, year, month, rows)}) TO '{path}' (FORMAT parquet)")
+            written += rows
+    logger.info(f"Wrote {written} rows across {len(periods)} months to {out_dir}")
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic TLC trip Parquet files")
+    parser.add_argument("--rows", type=int, default=1_000_000, help="yellow rows in total")
+    parser.add_argument("--years", default="2024", help="comma separated, e.g. 2023,2024")
+    parser.add_argument("--months", type=int, default=12, help="months per year, starting at January")
+    parser.add_argument("--out", default="bench_data")
+    args = parser.parse_args()
+    generate(args.out, args.rows, [int(y) for y in args.years.split(",")], list(range(1, args.months + 1)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import duckdb
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import generate
+import serve
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+## End-to-end benchmark: generates synthetic TLC files for each scale, serves them over a
+## local HTTP stand-in, then runs load.py, clean.py, dbt and analysis.py against a fresh
+## working directory. Every stage runs in its own process so wall time and peak RSS are
+## measured per stage, and one JSON line per stage is appended to the results file.
+
+REPO = Path(__file__).resolve().parent.parent
+STAGES = ["load", "clean", "dbt", "analysis"]
+
+PROFILE = """taxi_co2:
+  target: bench
+  outputs:
+    bench:
+      type: duckdb
+      path: '{db}'
+      schema: 'emissions'
+      threads: 4
+"""
+
+
+def stage_command(stage, work):
+    if stage == "dbt":
+        return ["dbt", "run", "--project-dir", str(REPO / "dbt"), "--profiles-dir", str(work),
+                "--target-path", str(work / "dbt" / "target")], work / "dbt"
+    script = {"load": "load.py", "clean": "clean.py", "analysis": "analysis.py"}[stage]
+    return [sys.executable, str(REPO / script)], work
+
+def run_stage(stage, work, env):
+    cmd, cwd = stage_command(stage, work)
+    started = time.perf_counter()
+    ## stderr goes to a file, a pipe nobody reads until wait4 returns would block a chatty stage
+    stderr_path = work / f"{stage}.stderr"
+    with open(stderr_path, "wb") as stderr:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=stderr)
+        ## wait4 reports the resource usage of this child alone
+        _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        logger.error(f"{stage} exited with {proc.returncode}: {stderr_path.read_text(errors='replace')[-2000:]}")
+    return wall, usage.ru_maxrss / 1024, proc.returncode
+
+def prepare_workdir(work):
+    shutil.rmtree(work, ignore_errors=True)
+    (work / "dbt" / "output").mkdir(parents=True)
+    (work / "profiles.yml").write_text(PROFILE.format(db=(work / "traffic.duckdb").as_posix()))
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, text=True).strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+def benchmark(scales, stages, years, months, bench_dir, results_path):
+    revision = git_revision()
+    for scale in scales:
+        data_dir = bench_dir / f"data_{scale}"
+        if not data_dir.exists():
+            generate.generate(str(data_dir), scale, years, months)
+        rows = duckdb.sql(
+            f"SELECT SUM(num_rows) FROM parquet_file_metadata('{data_dir}/*.parquet')"
+        ).fetchone()[0]
+
+        work = bench_dir / f"run_{scale}"
+        prepare_workdir(work)
+        server, base_url = serve.start(str(data_dir))
+        env = dict(os.environ, TLC_BASE_URL=base_url, ANALYSIS_CACHE="0", DBT_LOG_PATH=str(work / "dbt" / "logs"))
+        try:
+            for stage in stages:
+                logger.info(f"scale={scale} stage={stage} starting")
+                wall, peak_mb, code = run_stage(stage, work, env)
+                record = {
+                    "run_at": datetime.now().isoformat(timespec="seconds"),
+                    "revision": revision,
+                    "scale": scale,
+                    "stage": stage,
+                    "rows": rows,
+                    "wall_s": round(wall, 3),
+                    "rows_per_s": round(rows / wall) if wall else None,
+                    "peak_rss_mb": round(peak_mb, 1),
+                    "exit_code": code,
+                }
+                with open(results_path, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+                logger.info(f"scale={scale} stage={stage} {wall:.1f}s {peak_mb:.0f} MB peak")
+        finally:
+            server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic TLC data")
+    parser.add_argument("--scales", default="1000000", help="comma separated yellow row counts, e.g. 1000000,10000000")
+    parser.add_argument("--stages", default=",".join(STAGES))
+    parser.add_argument("--years", default="2024")
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--bench-dir", default="bench_work")
+    parser.add_argument("--results", default="bench/results.jsonl")
+    args = parser.parse_args()
+
+    stages = args.stages.split(",")
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {unknown}")
+    bench_dir = Path(args.bench_dir).resolve()
+    bench_dir.mkdir(parents=True, exist_ok=True)
+    benchmark([int(s) for s in args.scales.split(",")], stages,
+              [int(y) for y in args.years.split(",")], list(range(1, args.months + 1)),
+              bench_dir, args.results)
+
+if __name__ == "__main__":
+    main()
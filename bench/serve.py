@@ -0,0 +1,109 @@
+import argparse
+import email.utils
+import io
+import logging
+import os
+import re
+import threading
+from functools import partial
+from http import HTTPStatus
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+## Local stand-in for the TLC CDN. Point load.py at it with TLC_BASE_URL=http://host:port
+## Like the CDN it sends ETag and Last-Modified, answers conditional requests with 304 and
+## serves byte ranges, so the loader's download cache can be exercised end to end.
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    ## Stop a body after this many bytes to simulate a dropped connection (None = never)
+    truncate_after = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().send_head()
+        st = os.stat(path)
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        last_modified = self.date_time_string(int(st.st_mtime))
+
+        if self.not_modified(etag, st.st_mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return None
+
+        start, end = 0, st.st_size - 1
+        ranged = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", ranged or "")
+        partial_content = match is not None and if_range in (None, etag, last_modified)
+        if partial_content:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+            if start > end:
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header("Content-Range", f"bytes */{st.st_size}")
+                self.end_headers()
+                return None
+
+        length = end - start + 1
+        f = open(path, 'rb')
+        f.seek(start)
+        self.send_response(HTTPStatus.PARTIAL_CONTENT if partial_content else HTTPStatus.OK)
+        self.send_header("Content-type", self.guess_type(path))
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if partial_content:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{st.st_size}")
+        self.end_headers()
+
+        limit = length if self.truncate_after is None else min(length, self.truncate_after)
+        if limit < st.st_size - start:
+            with f:
+                return io.BytesIO(f.read(limit))
+        return f
+
+    def not_modified(self, etag, mtime):
+        if "If-None-Match" in self.headers:
+            return self.headers["If-None-Match"] == etag
+        if "If-Modified-Since" in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+            except (TypeError, ValueError):
+                return False
+            return since is not None and int(mtime) <= since.timestamp()
+        return False
+
+def start(directory, port=0, truncate_after=None):
+    """Serves directory in a background thread, returns (server, base_url)."""
+    handler = type("Handler", (QuietHandler,), {"truncate_after": truncate_after})
+    server = ThreadingHTTPServer(("127.0.0.1", port), partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    logger.info(f"Serving {directory} at {base_url}")
+    return server, base_url
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve generated trip files over HTTP")
+    parser.add_argument("--dir", default="bench_data")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--truncate-after", type=int, default=None,
+                        help="cut every response body after this many bytes, to test resumed downloads")
+    args = parser.parse_args()
+    server, _ = start(args.dir, args.port, args.truncate_after)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
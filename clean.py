@@ -1,5 +1,13 @@
-import duckdb
 import logging
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import connection
+import dq
+import instrument
+import schema
 
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
@@ -7,219 +15,266 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DB_FILE = "traffic.duckdb"
+DB_FILE = os.environ.get("DB_FILE", "traffic.duckdb")
+FLEETS = os.environ.get("FLEETS", "yellow,green").split(",") # Fleets cleaned by this run
+
+## Cleaning rules shared by both fleets, a row matching any of them is removed.
+## {pickup}/{dropoff} are filled in per fleet, {all_null} is every ingest column IS NULL.
+CLEANING_RULES = [
+    ('all_null', "{all_null}"),
+    ('zero_passengers', "passenger_count = 0"),
+    ('zero_distance', "trip_distance = 0"),
+    ('over_100_miles', "trip_distance > 100"),
+    ('over_24_hours', "date_diff('second', {pickup}, {dropoff}) > 86400"),
+]
+
+## Columns that identify a trip, rows agreeing on all of them are duplicates
+TRIP_KEY_COLUMNS = [
+    'VendorID', '{pickup}', '{dropoff}', 'PULocationID', 'DOLocationID', 'passenger_count', 'trip_distance',
+]
+
+CLEAN_WORKERS = int(os.environ.get("CLEAN_WORKERS", 2)) # Partitions cleaned at the same time
+LAKE_DIR = os.path.abspath(os.environ.get("LAKE_DIR", "lake")) # Same as load.py, lake mode writes the cleaned dataset here
+
+def rule_conditions(color):
+    pickup, dropoff = schema.TIME_COLUMNS[color]
+    all_null = " AND ".join(f"{c} IS NULL" for c in schema.column_names(color))
+    return [
+        (name, template.format(pickup=pickup, dropoff=dropoff, all_null=all_null))
+        for name, template in CLEANING_RULES
+    ]
+
+def keep_predicate(color):
+    ## COALESCE keeps rows where a rule can't be evaluated (e.g. NULL passenger_count),
+    ## matching what a DELETE ... WHERE rule would have left behind
+    matches = " OR\n                       ".join(
+        f"COALESCE({condition}, false)" for _, condition in rule_conditions(color)
+    )
+    return f"NOT (\n                       {matches}\n                   )"
+
+def trip_key(color):
+    ## The columns that identify a trip. DuckDB hashes them internally and then compares the
+    ## values, so trips whose hashes collide are still kept apart.
+    pickup, dropoff = schema.TIME_COLUMNS[color]
+    return ", ".join(c.format(pickup=pickup, dropoff=dropoff) for c in TRIP_KEY_COLUMNS)
+
+def keep_order(color):
+    ## Which copy of a duplicated trip is kept: the one from the earliest monthly file, then a
+    ## charge before its negative reversal, then the remaining columns. The order is total, so
+    ## re-cleaning the same rows keeps the same copies and the month fingerprints don't move.
+    pickup, dropoff = schema.TIME_COLUMNS[color]
+    key = {c.format(pickup=pickup, dropoff=dropoff) for c in TRIP_KEY_COLUMNS}
+    rest = [c for c in schema.column_names(color) if c not in key]
+    return ", ".join(["source_year", "source_month", "total_amount < 0"] + rest)
+
+def source_table(con, color):
+    ## In lake storage mode the raw rows are a read-only view over the Parquet partitions,
+    ## cleaning reads that and writes the cleaned rows to their own dataset
+    raw_view = schema.lake_view(color)
+    is_lake = con.execute("""
+                    SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ? AND table_type = 'VIEW'
+                """, [raw_view]).fetchone()[0]
+    return raw_view if is_lake else color
+
+def pickup_months(con, color, source):
+    ## Pickup month -> rows in that partition before cleaning
+    pickup, _ = schema.TIME_COLUMNS[color]
+    return dict(instrument.execute(con, f"""
+                    SELECT date_trunc('month', {pickup}), COUNT(*) FROM {source} GROUP BY ALL
+                """))
+
+def clean_partition(con, color, source, target, month, rows_in=None, lake=False):
+    ## target is a table, or with lake the directory of a year=/month= dataset
+    pickup, _ = schema.TIME_COLUMNS[color]
+    if month is None:
+        in_partition, params = f"{pickup} IS NULL", []
+    else:
+        in_partition, params = f"{pickup} >= ? AND {pickup} < ? + INTERVAL 1 MONTH", [month, month]
+
+    ## Each worker gets its own cursor, DuckDB lets appends to the same table run side by side
+    cur = con.cursor()
+    try:
+        with instrument.span('clean_partition', target=f"{color} {month:%Y-%m}" if month else f"{color} null") as s:
+            s['rows_in'] = rows_in
+            query = f"""
+                    SELECT *
+                    FROM {source}
+                    WHERE {in_partition}
+                      AND {keep_predicate(color)}
+                    QUALIFY row_number() OVER (
+                        PARTITION BY {trip_key(color)}
+                        ORDER BY {keep_order(color)}
+                    ) = 1
+                    ORDER BY {pickup}"""
+            if lake:
+                partition_dir = os.path.join(target, f"year={month.year}", f"month={month.month}")
+                os.makedirs(partition_dir, exist_ok=True)
+                sql = f"COPY ({query}\n                ) TO '{partition_dir}/data.parquet' (FORMAT parquet, COMPRESSION zstd)"
+            else:
+                sql = f"INSERT INTO {target}{query}"
+            kept = instrument.execute(cur, sql, params, fetch="fetchone")[0]
+            s['rows_out'] = kept
+        return kept
+    finally:
+        cur.close()
+
+def create_clean_manifest(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS clean_manifest (
+            color VARCHAR,
+            pickup_month TIMESTAMP,
+            row_count BIGINT,
+            fingerprint UBIGINT,
+            cleaned_at TIMESTAMP,
+            PRIMARY KEY (color, pickup_month)
+        )
+    """)
+
+def month_fingerprints(con, color, table):
+    ## Pickup month -> (rows, XOR of row hashes). Rows are unique after dedup, so any change
+    ## to a month's cleaned rows, from a new load or a new cleaning rule, changes its fingerprint
+    pickup, _ = schema.TIME_COLUMNS[color]
+    rows = instrument.execute(con, f"""
+                    SELECT date_trunc('month', {pickup}), COUNT(*), bit_xor(hash(t))
+                    FROM {table} t
+                    WHERE {pickup} IS NOT NULL
+                    GROUP BY ALL
+                """)
+    return {month: (count, fingerprint) for month, count, fingerprint in rows}
+
+def update_clean_manifest(con, color, months):
+    ## cleaned_at only moves for months whose cleaned rows changed, the incremental dbt models
+    ## rebuild exactly those. A month that lost all its rows is kept with row_count 0.
+    known = {month: (count, fingerprint) for month, count, fingerprint in con.execute(
+        "SELECT pickup_month, row_count, fingerprint FROM clean_manifest WHERE color = ?", [color]
+    ).fetchall()}
+    gone = {month: (0, None) for month, (count, _) in known.items() if month not in months and count}
+    changed = [[color, month, count, fingerprint] for month, (count, fingerprint) in {**months, **gone}.items()
+               if known.get(month) != (count, fingerprint)]
+    if changed:
+        con.executemany(
+            "INSERT OR REPLACE INTO clean_manifest VALUES (?, ?, ?, ?, current_timestamp)", changed
+        )
+    logger.info(f"{len(changed)} {color} pickup months changed since the last clean")
+    return len(changed)
+
+def clean_table(con, color, source, workers=CLEAN_WORKERS):
+    ## Dedup and filtering run one pickup month at a time, so peak memory follows the largest
+    ## month rather than the whole history. The result replaces the color table atomically.
+    ## Each month is written sorted by pickup time, so every row group covers a narrow time
+    ## range and its min/max zone map lets date-range filters skip it.
+    target = f"{color}_clean"
+    instrument.execute(con, f"CREATE OR REPLACE TABLE {target} AS SELECT * FROM {source} LIMIT 0")
+
+    months = pickup_months(con, color, source)
+    logger.info(f"Cleaning '{color}' across {len(months)} pickup-month partitions")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(clean_partition, con, color, source, target, m, n) for m, n in months.items()]
+        kept = sum(future.result() for future in futures)
+    fingerprints = month_fingerprints(con, color, target)
+
+    create_clean_manifest(con)
+    con.execute("BEGIN TRANSACTION")
+    try:
+        instrument.execute(con, f"DROP TABLE IF EXISTS {color}")
+        instrument.execute(con, f"ALTER TABLE {target} RENAME TO {color}")
+        update_clean_manifest(con, color, fingerprints)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    logger.info(f"Cleaned '{color}'")
+    return kept
+
+def clean_lake(con, color, source, workers=CLEAN_WORKERS):
+    ## Lake storage mode: the cleaned rows become their own year=/month= dataset, partitioned by
+    ## pickup month and sorted by pickup time within each file, and the color view reads it.
+    ## The new dataset is written next to the old one and swapped in once complete.
+    final = os.path.join(LAKE_DIR, schema.clean_lake_dir(color))
+    staged, old = f"{final}.new", f"{final}.old"
+    shutil.rmtree(staged, ignore_errors=True)
+
+    months = pickup_months(con, color, source)
+    ## A trip without a pickup time has no partition, and no model or query could use it anyway
+    dropped = months.pop(None, 0)
+    if dropped:
+        logger.warning(f"Dropping {dropped} {color} rows without a pickup time, they have no lake partition")
+    logger.info(f"Cleaning '{color}' into {staged} across {len(months)} pickup-month partitions")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(clean_partition, con, color, source, staged, m, n, True) for m, n in months.items()]
+        kept = sum(future.result() for future in futures)
+    fingerprints = month_fingerprints(con, color, f"read_parquet('{staged}/*/*/*.parquet')") if months else {}
+
+    create_clean_manifest(con)
+    if os.path.isdir(final):
+        os.replace(final, old)
+    os.replace(staged, final)
+    shutil.rmtree(old, ignore_errors=True)
+    con.execute("BEGIN TRANSACTION")
+    try:
+        ## A table of that name is left from table storage, or from before cleaned lake data had its own dataset
+        if con.execute("SELECT COUNT(*) FROM duckdb_tables() WHERE table_name = ?", [color]).fetchone()[0]:
+            instrument.execute(con, f"DROP TABLE {color}")
+        if months:
+            instrument.execute(con, schema.clean_lake_view_sql(color, LAKE_DIR))
+        update_clean_manifest(con, color, fingerprints)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    logger.info(f"Cleaned '{color}' into {final}")
+    return kept
 
 def clean():
     con = None
     try:
-        con = duckdb.connect(database=DB_FILE, read_only=False)
-        con.execute("PRAGMA memory_limit='20GB'")
+        ## Sized from the host instead of a fixed limit, the rewrite doesn't need insertion order
+        con = connection.connect(DB_FILE, bulk=True)
         logger.info(f"Connected to database: {DB_FILE}")
+        ## One run id ties the dq report to this run's timings
+        run_id = instrument.start_run('clean')
+
+        sources = {color: source_table(con, color) for color in FLEETS}
+
+        ## Before/after quality metrics are each a single aggregate scan per table
+        report = {}
+        for color in FLEETS:
+            with instrument.span('measure_before', target=color):
+                report[color] = {'before': dq.measure(con, color, rule_conditions(color), sources[color])}
+
+        ## Dedup and every rule run as one rewrite per table, partition by partition
+        logger.info("Removing duplicate and invalid rows...")
+        for color in FLEETS:
+            with instrument.span('clean_table', target=color) as s:
+                s['rows_in'] = report[color]['before']['row_count']
+                if sources[color] == color:
+                    s['rows_out'] = clean_table(con, color, sources[color])
+                else:
+                    s['rows_out'] = clean_lake(con, color, sources[color])
 
-        
-        yellow_original_count = con.execute(f"""
-                    SELECT COUNT(*) FROM yellow
-                """).fetchone()[0]
-
-        green_original_count = con.execute(f"""
-                    SELECT COUNT(*) FROM green
-                """).fetchone()[0]
-
-        ## Remove duplicate rows
-        logger.info("Removing duplicate rows...")
-        # Yellow table
-        con.execute("CREATE TABLE yellow_clean AS SELECT DISTINCT * FROM yellow")
-        con.execute("DROP TABLE yellow")
-        con.execute("ALTER TABLE yellow_clean RENAME TO yellow")
-
-        # Green table
-        con.execute("CREATE TABLE green_clean AS SELECT DISTINCT * FROM green")
-        con.execute("DROP TABLE green")
-        con.execute("ALTER TABLE green_clean RENAME TO green")
-
-        
-
-        logger.info("Dropped duplicate rows")
-
-        logger.info("Deleting null value rows...")
-        con.execute(f"""
-                    DELETE FROM yellow
-                    WHERE 
-                    
-                    VendorID IS NULL AND 
-                    tpep_pickup_datetime IS NULL AND 
-                    tpep_dropoff_datetime IS NULL AND
-                     store_and_fwd_flag IS NULL AND 
-                     RatecodeID IS NULL AND 
-                     PULocationID IS NULL AND 
-                     DOLocationID IS NULL AND
-                     passenger_count IS NULL 
-                     AND trip_distance IS NULL AND 
-                     fare_amount IS NULL AND 
-                     extra IS NULL 
-                     AND mta_tax IS NULL AND
-                     tip_amount IS NULL AND 
-                     tolls_amount IS NULL AND 
-                     improvement_surcharge IS NULL AND
-                     total_amount IS NULL AND 
-                     payment_type IS NULL AND 
-                     congestion_surcharge IS NULL AND 
-                     airport_fee IS NULL
-                                     
-                    ;
-                """)
-        con.execute(f"""
-                    DELETE FROM green
-                    WHERE 
-                    
-                    VendorID IS NULL AND 
-                    lpep_pickup_datetime IS NULL AND 
-                    lpep_dropoff_datetime IS NULL AND
-                     store_and_fwd_flag IS NULL AND 
-                     RatecodeID IS NULL AND 
-                     PULocationID IS NULL AND 
-                     DOLocationID IS NULL AND
-                     passenger_count IS NULL AND 
-                     trip_distance IS NULL AND 
-                     fare_amount IS NULL AND 
-                     extra IS NULL AND 
-                     mta_tax IS NULL AND
-                     tip_amount IS NULL AND 
-                     tolls_amount IS NULL AND 
-                     ehail_fee IS NULL AND 
-                     improvement_surcharge IS NULL AND
-                     total_amount IS NULL AND 
-                     payment_type IS NULL AND 
-                     trip_type IS NULL AND 
-                     congestion_surcharge IS NULL 
-                     ;
-                """)
-
-
-        logger.info("Deleted")
-
-        ## Deleting those with 0 passengers
-        con.execute(f"""
-                    DELETE FROM yellow
-                    WHERE passenger_count = 0
-                """)
-
-        con.execute(f"""
-                    DELETE FROM green
-                    WHERE passenger_count = 0
-                """)
-
-        ## Deleting those with 0 distance
-        con.execute(f"""
-                    DELETE FROM yellow
-                    WHERE trip_distance = 0
-                """)
-
-        con.execute(f"""
-                    DELETE FROM green
-                    WHERE trip_distance = 0
-                """)
-
-        ## Deleting those with over 100 in distance
-        con.execute(f"""
-                    DELETE FROM yellow
-                    WHERE trip_distance > 100
-                """)
-
-        con.execute(f"""
-                    DELETE FROM green
-                    WHERE trip_distance > 100
-                """)
-
-        ## Deleting trips over 24 hours
-        con.execute(f"""
-                    DELETE FROM yellow
-                    WHERE date_diff('hour', tpep_dropoff_datetime, tpep_pickup_datetime) > 24
-                """)
-
-        con.execute(f"""
-                    DELETE FROM green
-                    WHERE date_diff('hour', lpep_dropoff_datetime, lpep_pickup_datetime) > 24
-                """)
-
-        ## Calculating difference in size from before and after
         logger.info("Cleaning executed")
         logger.info("Testing to see if cleaning succeeded...")
 
-        yellow_new_size = con.execute(f"""
-                    SELECT COUNT(*) from yellow;
-                """).fetchone()[0]
-        green_new_size = con.execute(f"""
-                    SELECT COUNT(*) from green;
-                """).fetchone()[0]
-
-        logger.info("# of duplicate yellow trips dropped: ", yellow_original_count - yellow_new_size)
-        logger.info("# of duplicate green trips dropped: ", green_original_count - green_new_size)
-
-        ## Returning numbers to check if cleaning worked
-        logger.info("# of 0 passengers in yellow: ", 
-        con.execute(f"""
-                    SELECT COUNT(*) FROM yellow
-                    WHERE passenger_count = 0;
-                """)
-                )
-
-        logger.info("# of 0 passengers in green: ",
-        con.execute(f"""
-                    SELECT COUNT(*) FROM green
-                    WHERE passenger_count = 0;
-                """)
-                )
-
-        logger.info("# of 100 passengers in yellow: ",
-        con.execute(f"""
-                    SELECT COUNT(*) FROM yellow
-                    WHERE passenger_count = 100;
-                """)
-                )
-
-        logger.info("# of 100 passengers in green: ",
-        con.execute(f"""
-                    SELECT COUNT(*) FROM green
-                    WHERE passenger_count = 100;
-                """)
-                )
-
-        logger.info("# of NULL passengers in green: ",
-        con.execute(f"""
-                    SELECT COUNT(*) FROM green
-                    WHERE passenger_count IS NULL;
-                """)
-                )
-                
+        for color in FLEETS:
+            with instrument.span('measure_after', target=color):
+                report[color]['after'] = dq.measure(con, color, rule_conditions(color))
+            for stage, metrics in report[color].items():
+                dq.record(con, run_id, color, stage, metrics)
+            dq.log_report(color, report[color]['before'], report[color]['after'])
 
-        logger.info("# of NULL passengers in yellow: ",
-        con.execute(f"""
-                    SELECT COUNT(*) FROM yellow
-                    WHERE passenger_count IS NULL;
-                """)
-                )
-
-        logger.info("# of yellow trips > 24 hrs: ",
-        con.execute(f"""
-                    SELECT COUNT(*) FROM yellow
-                    WHERE date_diff('hour', tpep_dropoff_datetime, tpep_pickup_datetime) > 24;
-                """)
-                )
-
-        logger.info("# of green trips > 24 hrs: ",
-        con.execute(f"""
-                    SELECT COUNT(*) FROM green
-                    WHERE date_diff('hour', lpep_dropoff_datetime, lpep_pickup_datetime) > 24;
-                """)
-                )
+        path = dq.write_json(run_id, report)
+        logger.info(f"Data-quality report {run_id} written to dq_report table and {path}")
+        return True
 
     except Exception as e:
         logger.critical(f"A critical error occurred in the main script: {e}")
+        return False
     finally:
         if con:
+            instrument.flush(con)
             con.close()
             logger.info("DuckDB connection closed.")
 
 if __name__ == "__main__":
-    clean()
\ No newline at end of file
+    if not clean():
+        sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,95 @@
+import logging
+import os
+import tempfile
+
+import duckdb
+
+logger = logging.getLogger(__name__)
+
+## Shared DuckDB connection factory. memory_limit and threads are sized from what this
+## process can actually use: physical RAM and usable cores, capped by cgroup limits when
+## running in a container, and divided by DUCKDB_PROCESSES when several pipeline stages
+## share the host. Spills go to a temp directory next to the database. Each setting can
+## be pinned with its own environment variable.
+
+MEMORY_FRACTION = float(os.environ.get("DUCKDB_MEMORY_FRACTION", 0.7)) # The rest is left to Python, pandas and the OS
+PROCESSES = int(os.environ.get("DUCKDB_PROCESSES", 1)) # DuckDB processes sharing this host
+MEMORY_LIMIT = os.environ.get("DUCKDB_MEMORY_LIMIT") # e.g. "12GB", overrides the computed limit
+THREADS = os.environ.get("DUCKDB_THREADS")
+TEMP_DIR = os.environ.get("DUCKDB_TEMP_DIR")
+MIN_MEMORY_LIMIT = 256 * 1024 ** 2 # DuckDB can't do much with less, even on a tiny host
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def cgroup_memory_bytes():
+    v2 = _read("/sys/fs/cgroup/memory.max")
+    if v2 is not None:
+        return None if v2 == "max" else int(v2)
+    v1 = _read("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+    ## cgroup v1 reports a number close to 2^63 when there is no limit
+    if v1 is not None and int(v1) < 1 << 60:
+        return int(v1)
+    return None
+
+def cgroup_cpus():
+    v2 = _read("/sys/fs/cgroup/cpu.max")
+    if v2 is not None:
+        quota, period = v2.split()
+        return None if quota == "max" else int(quota) / int(period)
+    quota = _read("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+def host_memory_bytes():
+    total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = cgroup_memory_bytes()
+    return min(total, limit) if limit else total
+
+def host_cpus():
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    quota = cgroup_cpus()
+    if quota:
+        cpus = min(cpus, int(quota))
+    return max(1, cpus)
+
+def memory_budget():
+    """Bytes of memory this process should plan to use for query data, DuckDB or pandas."""
+    return int(host_memory_bytes() * MEMORY_FRACTION / PROCESSES)
+
+def settings(database=":memory:", bulk=False):
+    if TEMP_DIR:
+        temp_directory = TEMP_DIR
+    elif database in (":memory:", ""):
+        temp_directory = os.path.join(tempfile.gettempdir(), "duckdb_spill")
+    else:
+        temp_directory = f"{database}.tmp"
+    config = {
+        'memory_limit': MEMORY_LIMIT or f"{max(memory_budget(), MIN_MEMORY_LIMIT) // 1024 ** 2}MiB",
+        'threads': int(THREADS) if THREADS else max(1, host_cpus() // PROCESSES),
+        'temp_directory': temp_directory,
+    }
+    if bulk:
+        ## Bulk loads and rewrites don't depend on row order, dropping it lets DuckDB
+        ## write in parallel and keep less buffered data in memory
+        config['preserve_insertion_order'] = False
+    return config
+
+def connect(database=":memory:", read_only=False, bulk=False):
+    """Opens a DuckDB connection with memory, threads and spill directory sized for this host.
+
+    Every connection a process opens to the same file must use the same bulk flag,
+    DuckDB refuses a second configuration for a database that is already open.
+    """
+    config = settings(database, bulk)
+    con = duckdb.connect(database=database, read_only=read_only, config=config)
+    logger.info(f"Opened {database} with memory_limit={config['memory_limit']}, threads={config['threads']}, "
+                f"temp_directory={config['temp_directory']}{', bulk' if bulk else ''}")
+    return con
@@ -0,0 +1,35 @@
+{% macro fleet_trips(fleet) %}
+{%- set cfg = var('fleets')[fleet] -%}
+-- {{ fleet }}: map the fleet's columns onto the shared trip layout
+SELECT
+    '{{ fleet }}' AS fleet,
+    {{ cfg.pickup }} AS pickup_datetime,
+    {{ cfg.dropoff }} AS dropoff_datetime,
+    trip_distance,
+    VendorID,
+    RatecodeID,
+    passenger_count,
+    PULocationID,
+    DOLocationID,
+    payment_type,
+    DATE_TRUNC('month', {{ cfg.pickup }}) AS pickup_month,
+    -- Emission factor is a per-fleet constant, looked up once rather than joined per row
+    (
+        SELECT e.co2_grams_per_mile
+        FROM {{ source('main', 'emissions') }} e
+        JOIN {{ source('main', 'fleets') }} f USING (vehicle_type)
+        WHERE f.fleet = '{{ fleet }}'
+    ) AS co2_grams_per_mile
+FROM {{ source('main', fleet) }}
+{% if is_incremental() %}
+{%- set rebuilt -%}
+    SELECT pickup_month FROM ({{ missing_months(cleaned_months()) }}) WHERE fleet = '{{ fleet }}'
+{%- endset %}
+-- Only the pickup months the table lacks, new ones and the ones the pre-hook dropped. The range
+-- bounds are what lets DuckDB skip row groups: the cleaned tables are clustered by pickup time,
+-- and an IN list over DATE_TRUNC can't be checked against the zone maps.
+WHERE {{ cfg.pickup }} >= (SELECT MIN(pickup_month) FROM ({{ rebuilt }}))
+  AND {{ cfg.pickup }} < (SELECT MAX(pickup_month) FROM ({{ rebuilt }})) + INTERVAL 1 MONTH
+  AND DATE_TRUNC('month', {{ cfg.pickup }}) IN ({{ rebuilt }})
+{% endif %}
+{% endmacro %}
@@ -0,0 +1,62 @@
+{#- The incremental models rebuild whole (fleet, pickup_month) partitions. Their pre-hook deletes
+    the partitions whose input changed after they were built, or that their input no longer has,
+    and the model then appends every partition its input has and the table lacks. Deleting by key
+    set keeps this linear in the table size, delete+insert joins every new row against every old
+    row of the same month.
+
+    `inputs` is a query returning fleet, pickup_month and changed_at for each input partition. -#}
+
+{% macro delete_stale_months(inputs) %}
+{% if is_incremental() %}
+DELETE FROM {{ this }}
+WHERE (fleet, pickup_month) IN (
+    SELECT b.fleet, b.pickup_month
+    FROM (
+        SELECT fleet, pickup_month, MAX(processed_at) AS built_at
+        FROM {{ this }}
+        GROUP BY ALL
+    ) b
+    LEFT JOIN ({{ inputs }}) i USING (fleet, pickup_month)
+    WHERE i.changed_at IS NULL OR i.changed_at > b.built_at
+)
+{% endif %}
+{% endmacro %}
+
+{% macro delete_changed_factors() %}
+{% if is_incremental() %}
+-- Each trip carries the emission factor it was built with, a partition whose factor no longer
+-- matches the emissions table is dropped and rebuilt with the current one
+DELETE FROM {{ this }}
+WHERE (fleet, pickup_month) IN (
+    SELECT DISTINCT t.fleet, t.pickup_month
+    FROM {{ this }} t
+    JOIN {{ source('main', 'fleets') }} f ON f.fleet = t.fleet
+    LEFT JOIN {{ source('main', 'emissions') }} e ON e.vehicle_type = f.vehicle_type
+    WHERE t.co2_grams_per_mile IS DISTINCT FROM e.co2_grams_per_mile
+)
+{% endif %}
+{% endmacro %}
+
+{% macro missing_months(inputs) %}
+    SELECT i.fleet, i.pickup_month
+    FROM ({{ inputs }}) i
+    WHERE NOT EXISTS (
+        SELECT 1 FROM {{ this }} t
+        WHERE t.fleet = i.fleet AND t.pickup_month = i.pickup_month
+    )
+{% endmacro %}
+
+{% macro cleaned_months() %}
+    -- clean.py moves cleaned_at only when a month's cleaned rows change, whether from a load
+    -- or from a change to the cleaning rules
+    SELECT color AS fleet, pickup_month, cleaned_at AS changed_at
+    FROM {{ source('main', 'clean_manifest') }}
+    WHERE row_count > 0
+{% endmacro %}
+
+{% macro trip_months() %}
+    -- Each pickup month of the trips model is rebuilt in one run, so its processed_at says when
+    SELECT fleet, pickup_month, MAX(processed_at) AS changed_at
+    FROM {{ ref('trips') }}
+    GROUP BY ALL
+{% endmacro %}
@@ -0,0 +1,27 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='append',
+    pre_hook="{{ delete_stale_months(trip_months()) }}"
+) }}
+
+-- CO2 sums, counts and maxima per fleet and time bucket. A few thousand rows that answer every
+-- question in analysis.py, so reporting never has to scan the trip table.
+SELECT
+    fleet,
+    pickup_month,
+    CAST(EXTRACT(year FROM pickup_month) AS SMALLINT) AS year,
+    month_of_year,
+    week_of_year,
+    day_of_week,
+    hour_of_day,
+    COUNT(*) AS trip_count,
+    SUM(trip_co2_kgs) AS co2_sum_kgs,
+    MAX(trip_co2_kgs) AS co2_max_kgs,
+    CAST(CURRENT_TIMESTAMP AS TIMESTAMP) AS processed_at
+FROM {{ ref('trips') }}
+WHERE trip_co2_kgs IS NOT NULL
+{% if is_incremental() %}
+  -- Only pickup months the trip model rebuilt since the rollup last built them
+  AND (fleet, pickup_month) IN ({{ missing_months(trip_months()) }})
+{% endif %}
+GROUP BY ALL
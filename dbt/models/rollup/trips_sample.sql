@@ -0,0 +1,32 @@
+{#- Stratified sample of trips for analysis.py's approximate engine (ANALYSIS_ENGINE=sample).
+    Every fleet and pickup month is a stratum, sampled at var('sample_rate') but never below
+    var('sample_min_rows') rows, so small months still give usable intervals. Rebuilt on every
+    run, so the sample follows each load. -#}
+{{ config(materialized='table') }}
+
+WITH eligible AS (
+    -- Same row filters analysis.py applies to the trip export
+    SELECT
+        fleet, pickup_month, pickup_datetime, dropoff_datetime, trip_distance, trip_co2_kgs,
+        duration_minutes, hour_of_day, day_of_week, week_of_year, month_of_year
+    FROM {{ ref('trips') }}
+    WHERE pickup_datetime IS NOT NULL AND dropoff_datetime IS NOT NULL
+      AND trip_distance > 0 AND duration_minutes > 0 AND trip_co2_kgs >= 0
+),
+
+strata AS (
+    SELECT
+        fleet,
+        pickup_month,
+        COUNT(*) AS stratum_rows,
+        LEAST(1.0, GREATEST({{ var('sample_rate') }}, {{ var('sample_min_rows') }} / COUNT(*))) AS sample_rate
+    FROM eligible
+    GROUP BY ALL
+)
+
+SELECT e.*, s.stratum_rows, s.sample_rate
+FROM eligible e
+JOIN strata s USING (fleet, pickup_month)
+-- A hash of the trip rather than random(), so unchanged months keep the same sample across rebuilds
+WHERE hash(e.fleet, e.pickup_datetime, e.dropoff_datetime, e.trip_distance, e.trip_co2_kgs)
+      / 18446744073709551616.0 < s.sample_rate
@@ -0,0 +1,46 @@
+{{ config(
+    materialized='incremental',
+    incremental_strategy='append',
+    pre_hook=[
+        "{{ delete_stale_months(cleaned_months()) }}",
+        "{{ delete_changed_factors() }}",
+    ]
+) }}
+
+-- One fact table for every fleet in var('fleets'), built in a single DuckDB plan
+WITH all_trips AS (
+{% for fleet in var('fleets') %}
+    {{ fleet_trips(fleet) }}
+    {% if not loop.last %}UNION ALL{% endif %}
+{% endfor %}
+),
+
+final_calculations AS (
+    SELECT
+        *,
+        -- 1. Trip CO2 in kilograms, trip_co2_kgs and is_valid_trip are schema.py macros shared with trips_query.py
+        trip_co2_kgs(trip_distance, co2_grams_per_mile) AS trip_co2_kgs,
+
+        -- 2. Trip duration in minutes
+        CAST(DATE_DIFF('minute', pickup_datetime, dropoff_datetime) AS INTEGER) AS duration_minutes,
+
+        -- 3. Average speed in mph
+        CASE
+            WHEN DATE_DIFF('minute', pickup_datetime, dropoff_datetime) > 0
+            THEN trip_distance / (DATE_DIFF('minute', pickup_datetime, dropoff_datetime)/60.0)
+            ELSE 0
+        END AS avg_mph,
+
+        -- 4. Time-based features
+        CAST(EXTRACT(hour FROM pickup_datetime) AS TINYINT) AS hour_of_day,
+        CAST(EXTRACT(dayofweek FROM pickup_datetime) AS TINYINT) AS day_of_week,
+        CAST(EXTRACT(week FROM pickup_datetime) AS TINYINT) AS week_of_year,
+        CAST(EXTRACT(month FROM pickup_datetime) AS TINYINT) AS month_of_year
+    FROM all_trips
+)
+
+SELECT
+    *,
+    CAST(CURRENT_TIMESTAMP AS TIMESTAMP) AS processed_at
+FROM final_calculations
+WHERE is_valid_trip(trip_distance, pickup_datetime, dropoff_datetime)
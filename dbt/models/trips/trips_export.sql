@@ -0,0 +1,17 @@
+{#- Trip-level export for analysis.py, skip it with `--exclude trips_export` when only the rollup is needed.
+    Parquet by default, `--vars '{output_format: csv}'` restores the old CSV export and
+    `--vars '{partition_output: true}'` writes a fleet=F/month_of_year=N/ directory per month.
+    analysis.py reads whichever export is newest, pipeline.py clears the old ones before dbt runs -#}
+{%- set output_format = var('output_format', 'parquet') -%}
+{%- set partitioned = var('partition_output', false) and output_format == 'parquet' -%}
+{{ config(
+    materialized='external',
+    location='output/trips' ~ ('' if partitioned else '.' ~ output_format),
+    format=output_format,
+    options=({'partition_by': 'fleet, month_of_year', 'overwrite_or_ignore': true, 'compression': 'zstd'} if partitioned
+             else {'compression': 'zstd'} if output_format == 'parquet'
+             else {'header': true})
+) }}
+
+SELECT * EXCLUDE (pickup_month, processed_at)
+FROM {{ ref('trips') }}
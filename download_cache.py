@@ -0,0 +1,223 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+## Content-addressed cache for downloaded source files. Bodies are stored once under
+## objects/<sha256>.parquet, and refs/<sha256 of url>.json records which object a URL
+## resolved to along with its ETag and Last-Modified, so the next fetch is a conditional
+## request that returns 304 when nothing changed. Interrupted transfers stay in partial/
+## and are resumed with a Range request. Objects are touched on every hit and the least
+## recently used are evicted once the cache grows past its size cap. Objects handed out by
+## fetch() are pinned to the calling process until unpin(), so loads running in parallel
+## processes never evict each other's files.
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _url_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+def object_path(cache_dir, sha256):
+    return os.path.join(cache_dir, "objects", f"{sha256}.parquet")
+
+def _ref_path(cache_dir, url):
+    return os.path.join(cache_dir, "refs", f"{_url_key(url)}.json")
+
+def _partial_paths(cache_dir, url):
+    base = os.path.join(cache_dir, "partial", _url_key(url))
+    return f"{base}.part", f"{base}.json"
+
+def _discard_partial(cache_dir, url):
+    for path in _partial_paths(cache_dir, url):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def _write_json(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _touch(path):
+    now = time.time()
+    os.utime(path, (now, now))
+
+def _pin_path(cache_dir, path):
+    return os.path.join(cache_dir, "pins", f"{os.path.basename(path)}.{os.getpid()}")
+
+def pin(cache_dir, path):
+    os.makedirs(os.path.join(cache_dir, "pins"), exist_ok=True)
+    open(_pin_path(cache_dir, path), 'a').close()
+
+def unpin(cache_dir, path):
+    try:
+        os.remove(_pin_path(cache_dir, path))
+    except FileNotFoundError:
+        pass
+
+def _pinned(cache_dir):
+    pins_dir = os.path.join(cache_dir, "pins")
+    pinned = set()
+    if not os.path.isdir(pins_dir):
+        return pinned
+    for name in os.listdir(pins_dir):
+        obj, _, pid = name.rpartition('.')
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            ## Left behind by a process that has exited
+            try:
+                os.remove(os.path.join(pins_dir, name))
+            except FileNotFoundError:
+                pass
+            continue
+        except (ValueError, PermissionError):
+            pass
+        pinned.add(obj)
+    return pinned
+
+def lookup(cache_dir, url):
+    """Cached entry for url, or None when it was never fetched or its object has been evicted."""
+    ref = _read_json(_ref_path(cache_dir, url))
+    if ref is None or not os.path.exists(object_path(cache_dir, ref['sha256'])):
+        return None
+    return ref
+
+def fetch(cache_dir, url, headers=None, timeout=60):
+    """Returns the cache entry for url, revalidated with the server and resumed where possible.
+
+    HTTP errors are raised as requests exceptions. A transfer that breaks off leaves its
+    partial file behind, so calling fetch again continues from the last byte written.
+    The returned object is pinned, call unpin() once it has been read.
+    """
+    for sub in ("objects", "refs", "partial"):
+        os.makedirs(os.path.join(cache_dir, sub), exist_ok=True)
+    part_path, part_meta_path = _partial_paths(cache_dir, url)
+    request_headers = dict(headers or {})
+
+    cached = lookup(cache_dir, url)
+    if cached is not None:
+        if cached.get('etag'):
+            request_headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            request_headers['If-Modified-Since'] = cached['last_modified']
+
+    ## Resume only when the partial can be tied to a version of the file, If-Range makes the
+    ## server send the whole body instead if that version has since changed
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    part_meta = _read_json(part_meta_path) if offset else None
+    validator = part_meta and (part_meta.get('etag') or part_meta.get('last_modified'))
+    if offset and validator:
+        request_headers['Range'] = f"bytes={offset}-"
+        request_headers['If-Range'] = validator
+    else:
+        offset = 0
+
+    with requests.get(url, headers=request_headers, stream=True, timeout=timeout) as r:
+        if r.status_code == 304:
+            path = object_path(cache_dir, cached['sha256'])
+            pin(cache_dir, path)
+            if not os.path.exists(path):
+                unpin(cache_dir, path)
+                raise requests.exceptions.RequestException(f"Cached copy of {url} was evicted, fetching again")
+            _touch(path)
+            logger.info(f"{url} not modified, using cached {cached['sha256'][:12]}")
+            return dict(cached, path=path, from_cache=True, bytes_transferred=0)
+        if r.status_code == 416 and offset:
+            ## The partial already reaches the end of the file, e.g. the process died between the
+            ## last chunk and the rename. Start over rather than guess whether it is complete.
+            logger.info(f"Partial download of {url} is not resumable at byte {offset}, fetching it again")
+            _discard_partial(cache_dir, url)
+            return fetch(cache_dir, url, headers, timeout)
+        r.raise_for_status()
+
+        if r.status_code == 206:
+            match = re.match(r"bytes (\d+)-\d+/(\d+|\*)", r.headers.get('Content-Range', ''))
+            if match is None or int(match.group(1)) != offset:
+                _discard_partial(cache_dir, url)
+                raise requests.exceptions.RequestException(f"Unexpected Content-Range for {url}, restarting")
+            total = int(match.group(2)) if match.group(2) != '*' else None
+            etag, last_modified = part_meta.get('etag'), part_meta.get('last_modified')
+            logger.info(f"Resuming {url} at byte {offset}")
+        else:
+            offset = 0
+            length = r.headers.get('Content-Length')
+            total = int(length) if length is not None else None
+            etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+            _write_json(part_meta_path, {'url': url, 'etag': etag, 'last_modified': last_modified})
+
+        h = hashlib.sha256()
+        if offset:
+            with open(part_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    h.update(chunk)
+        transferred = 0
+        with open(part_path, 'ab' if offset else 'wb') as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
+                h.update(chunk)
+                transferred += len(chunk)
+
+    size = os.path.getsize(part_path)
+    if total is not None and size != total:
+        raise requests.exceptions.RequestException(f"{url} ended after {size} of {total} bytes")
+
+    sha256 = h.hexdigest()
+    path = object_path(cache_dir, sha256)
+    pin(cache_dir, path)
+    if os.path.exists(path):
+        ## Same bytes already cached, e.g. a file re-published with a new ETag
+        os.remove(part_path)
+    else:
+        os.replace(part_path, path)
+    _touch(path)
+    os.remove(part_meta_path)
+
+    entry = {'url': url, 'sha256': sha256, 'size': size, 'etag': etag, 'last_modified': last_modified}
+    _write_json(_ref_path(cache_dir, url), entry)
+    return dict(entry, path=path, from_cache=False, bytes_transferred=transferred)
+
+def evict(cache_dir, max_bytes):
+    """Removes least recently used objects until the cache fits in max_bytes, skipping pinned ones."""
+    objects_dir = os.path.join(cache_dir, "objects")
+    if not os.path.isdir(objects_dir):
+        return
+    entries = []
+    for name in os.listdir(objects_dir):
+        path = os.path.join(objects_dir, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            ## Evicted by another process in the meantime
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    pinned = _pinned(cache_dir)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        if os.path.basename(path) in pinned:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        logger.info(f"Evicted {os.path.basename(path)} from the download cache")
@@ -0,0 +1,67 @@
+import json
+import logging
+import os
+from datetime import datetime
+
+import instrument
+import schema
+
+logger = logging.getLogger(__name__)
+
+DQ_DIR = "dq_reports" # One JSON file per run is kept here
+
+
+def create_report_table(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS dq_report (
+            run_id VARCHAR,
+            run_at TIMESTAMP,
+            color VARCHAR,
+            stage VARCHAR,
+            metric VARCHAR,
+            value BIGINT
+        )
+    """)
+
+def measure(con, color, rules, table=None):
+    """Row count, hits for every (name, condition) rule and nulls per ingest column, in one scan of table (default color)."""
+    metrics = [('row_count', "COUNT(*)")]
+    for name, condition in rules:
+        metrics.append((f"rule:{name}", f"COUNT(*) FILTER (WHERE COALESCE({condition}, false))"))
+    for column in schema.column_names(color):
+        metrics.append((f"null:{column}", f"COUNT(*) FILTER (WHERE {column} IS NULL)"))
+
+    select = ",\n            ".join(f'{expr} AS "{name}"' for name, expr in metrics)
+    values = instrument.execute(con, f"""
+        SELECT
+            {select}
+        FROM {table or color}
+    """, fetch="fetchone")
+    return dict(zip([name for name, _ in metrics], values))
+
+def record(con, run_id, color, stage, metrics):
+    create_report_table(con)
+    run_at = datetime.now()
+    con.executemany(
+        "INSERT INTO dq_report VALUES (?, ?, ?, ?, ?, ?)",
+        [[run_id, run_at, color, stage, metric, value] for metric, value in metrics.items()],
+    )
+
+def write_json(run_id, report, out_dir=DQ_DIR):
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"dq_report_{run_id}.json")
+    with open(path, 'w') as f:
+        json.dump({'run_id': run_id, 'report': report}, f, indent=2)
+    return path
+
+def log_report(color, before, after):
+    logger.info(f"{color}: {before['row_count']} rows before cleaning, {after['row_count']} after "
+                f"({before['row_count'] - after['row_count']} removed)")
+    for metric, value in after.items():
+        if metric.startswith('rule:'):
+            logger.info(f"{color}: {metric} matched {before[metric]} rows before, {value} after")
+            if value:
+                logger.warning(f"{color}: cleaning left {value} rows matching {metric}")
+    for metric, value in after.items():
+        if metric.startswith('null:') and value:
+            logger.info(f"{color}: {metric} = {value}")
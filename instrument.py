@@ -0,0 +1,201 @@
+import itertools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+## Structured timing for load.py, clean.py and analysis.py. Each step runs inside a span
+## that records duration, rows in/out, bytes read and the process peak RSS. Spans are
+## appended to a JSON-lines file as they finish and written to the stage_metrics table
+## by flush(). With DUCKDB_PROFILE set, statements run through execute() are profiled
+## by DuckDB, summarised in query_profile and their full profile is kept on disk.
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "metrics")
+METRICS_FILE = os.path.join(METRICS_DIR, "metrics.jsonl")
+PROFILE = os.environ.get("DUCKDB_PROFILE", "off") # "off", "json" or "explain" (EXPLAIN ANALYZE tree)
+
+_run = {'run_id': None, 'stage': None}
+_spans = []
+_queries = []
+_lock = threading.Lock()
+_local = threading.local()
+_statement_no = itertools.count(1)
+
+
+def new_run_id():
+    return f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+def start_run(stage):
+    _run['run_id'] = new_run_id()
+    _run['stage'] = stage
+    with _lock:
+        _spans.clear()
+        _queries.clear()
+    return _run['run_id']
+
+def peak_rss_mb():
+    ## High-water mark of the whole process so far (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _write_line(record):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with _lock:
+        with open(METRICS_FILE, 'a') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+def _current_span():
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else (None, None)
+
+@contextmanager
+def span(step, target=None, **fields):
+    """Times one step. The yielded dict takes rows_in, rows_out, bytes_read and any extra detail."""
+    record = {'rows_in': None, 'rows_out': None, 'bytes_read': None}
+    record.update(fields)
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    _local.stack.append((step, record))
+    started_at = datetime.now()
+    started = time.perf_counter()
+    status = 'ok'
+    try:
+        yield record
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        _local.stack.pop()
+        duration = time.perf_counter() - started
+        row = {
+            'kind': 'span',
+            'run_id': _run['run_id'],
+            'stage': _run['stage'],
+            'step': step,
+            'target': target,
+            'started_at': started_at.isoformat(),
+            'duration_s': round(duration, 6),
+            'rows_in': record.pop('rows_in'),
+            'rows_out': record.pop('rows_out'),
+            'bytes_read': record.pop('bytes_read'),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'status': status,
+            'detail': record,
+        }
+        _write_line(row)
+        with _lock:
+            _spans.append(row)
+        logger.debug(f"{step} {target or ''} took {duration:.3f}s")
+
+def execute(con, sql, params=None, fetch="fetchall"):
+    """Runs one statement and returns result.<fetch>(), profiled by DuckDB when DUCKDB_PROFILE is set."""
+    if PROFILE == 'off':
+        return getattr(con.execute(sql, params), fetch)()
+
+    con.execute("PRAGMA enable_profiling='no_output'")
+    con.execute(f"SET profiling_mode='{'detailed' if PROFILE == 'explain' else 'standard'}'")
+    try:
+        ## Profiling information is only complete once the result has been fetched
+        result = getattr(con.execute(sql, params), fetch)()
+        profile = json.loads(con.get_profiling_information(format='json'))
+        tree = con.get_profiling_information(format='query_tree') if PROFILE == 'explain' else None
+    finally:
+        con.execute("PRAGMA disable_profiling")
+    _record_query(sql, profile, tree)
+    return result
+
+def _record_query(sql, profile, tree):
+    with _lock:
+        number = next(_statement_no)
+    profile_dir = os.path.join(METRICS_DIR, "profiles", str(_run['run_id']))
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, f"{number:05d}.{'txt' if tree else 'json'}")
+    with open(path, 'w') as f:
+        f.write(tree if tree else json.dumps(profile, indent=2))
+
+    step, enclosing = _current_span()
+    row = {
+        'kind': 'query',
+        'run_id': _run['run_id'],
+        'stage': _run['stage'],
+        'statement_no': number,
+        'step': step,
+        'latency_s': profile.get('latency'),
+        'cpu_time_s': profile.get('cpu_time'),
+        'rows_scanned': profile.get('cumulative_rows_scanned'),
+        'rows_returned': profile.get('rows_returned'),
+        'bytes_read': profile.get('total_bytes_read'),
+        'peak_buffer_mb': round(profile.get('system_peak_buffer_memory', 0) / 1024 / 1024, 1),
+        'profile_path': path,
+        'query': " ".join(sql.split())[:2000],
+    }
+    if enclosing is not None:
+        ## Statements add up inside the span they ran in
+        enclosing['sql_latency_s'] = enclosing.get('sql_latency_s', 0) + (row['latency_s'] or 0)
+        enclosing['sql_statements'] = enclosing.get('sql_statements', 0) + 1
+    _write_line(row)
+    with _lock:
+        _queries.append(row)
+
+def create_metrics_tables(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS stage_metrics (
+            run_id VARCHAR,
+            stage VARCHAR,
+            step VARCHAR,
+            target VARCHAR,
+            started_at TIMESTAMP,
+            duration_s DOUBLE,
+            rows_in BIGINT,
+            rows_out BIGINT,
+            bytes_read BIGINT,
+            peak_rss_mb DOUBLE,
+            status VARCHAR,
+            detail JSON
+        )
+    """)
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS query_profile (
+            run_id VARCHAR,
+            stage VARCHAR,
+            statement_no INTEGER,
+            step VARCHAR,
+            latency_s DOUBLE,
+            cpu_time_s DOUBLE,
+            rows_scanned BIGINT,
+            rows_returned BIGINT,
+            bytes_read BIGINT,
+            peak_buffer_mb DOUBLE,
+            profile_path VARCHAR,
+            query VARCHAR
+        )
+    """)
+
+def flush(con):
+    """Writes the spans and query profiles collected so far to the metrics tables."""
+    with _lock:
+        spans, queries = list(_spans), list(_queries)
+        _spans.clear()
+        _queries.clear()
+    create_metrics_tables(con)
+    if spans:
+        con.executemany(
+            "INSERT INTO stage_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [[s['run_id'], s['stage'], s['step'], s['target'], s['started_at'], s['duration_s'],
+              s['rows_in'], s['rows_out'], s['bytes_read'], s['peak_rss_mb'], s['status'],
+              json.dumps(s['detail'], default=str)] for s in spans],
+        )
+    if queries:
+        con.executemany(
+            "INSERT INTO query_profile VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [[q['run_id'], q['stage'], q['statement_no'], q['step'], q['latency_s'], q['cpu_time_s'],
+              q['rows_scanned'], q['rows_returned'], q['bytes_read'], q['peak_buffer_mb'],
+              q['profile_path'], q['query']] for q in queries],
+        )
+    logger.info(f"Recorded {len(spans)} spans and {len(queries)} profiled statements for run {_run['run_id']}")
@@ -1,9 +1,17 @@
-import duckdb
 import os
 import logging
 import requests
 import time
 import random
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import connection
+import download_cache
+import instrument
+import schema
 
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
@@ -12,129 +20,363 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-DB_FILE = "traffic.duckdb"
-DOWNLOAD_DIR = "temp_downloads" # Directory to temporarily store files
+DB_FILE = os.environ.get("DB_FILE", "traffic.duckdb")
+FLEETS = os.environ.get("FLEETS", "yellow,green").split(",") # Fleets loaded by this run
+DOWNLOAD_DIR = "temp_downloads" # Content-addressed download cache, kept between runs
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", 6)) # Months fetched in parallel
+BASE_URL = os.environ.get("TLC_BASE_URL", "https://d37ci6vzurychx.cloudfront.net/trip-data")
+FULL_REFRESH = os.environ.get("FULL_REFRESH", "0") == "1" # Drop tables and manifest, reload everything
+STORAGE_MODE = os.environ.get("STORAGE_MODE", "table") # "table" or "lake" (year=/month= Parquet dataset)
+LAKE_DIR = os.path.abspath(os.environ.get("LAKE_DIR", "lake"))
+UNCHANGED = "unchanged" # Returned by fetch_month when the manifest already matches the remote file
 
 
 ### Added this because I was getting request errors when downloading straight from the url
-def download_file_with_retries(url, dest_folder, retries=15, delay=35):
+def download_file_with_retries(url, dest_folder, retries=15, base_delay=2, max_delay=60):
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
     
-    if not os.path.exists(dest_folder):
-        os.makedirs(dest_folder)
-        
-    local_filename = os.path.join(dest_folder, url.split('/')[-1])
-
     for attempt in range(retries):
         try:
-            logger.info(f"Attempt {attempt + 1} to download data")
-            with requests.get(url, headers=headers, stream=True) as r:
-                r.raise_for_status() # This will raise an error for bad responses (4xx or 5xx)
-                with open(local_filename, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        f.write(chunk)
-            logger.info(f"Success")
-            return local_filename
+            logger.info(f"Attempt {attempt + 1} to download {url}")
+            ## Conditional request against the cached copy, a failed attempt resumes where it stopped
+            entry = download_cache.fetch(dest_folder, url, headers=headers)
+            if not entry['from_cache']:
+                logger.info(f"Downloaded {url} ({entry['bytes_transferred']} bytes)")
+            return entry
+        except requests.exceptions.HTTPError as e:
+            ## A 4xx means the month isn't published, retrying won't help
+            if e.response is not None and 400 <= e.response.status_code < 500 and e.response.status_code != 429:
+                logger.warning(f"{url} not available: {e}")
+                return None
+            logger.warning(f"Download attempt {attempt + 1} failed: {e}")
         except requests.exceptions.RequestException as e:
             logger.warning(f"Download attempt {attempt + 1} failed: {e}")
-            if attempt < retries - 1:
-                # Wait before the next attempt
-                time.sleep(delay)
-            else:
-                logger.error(f"All download attempts failed.")
-                return None
 
-def process_data_for_color(con, color, years, months):
+        if attempt < retries - 1:
+            ## Exponential backoff with full jitter so parallel workers don't retry in lockstep
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+
+    logger.error(f"All download attempts failed for {url}")
+    return None
+
+def remote_metadata(url):
+    ## HEAD is cheap, so unchanged months can be skipped without downloading them
+    try:
+        r = requests.head(url, allow_redirects=True, timeout=30)
+        if r.status_code != 200:
+            return None, None
+        size = r.headers.get('Content-Length')
+        return (int(size) if size is not None else None), r.headers.get('ETag')
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"HEAD request failed for {url}: {e}")
+        return None, None
+
+def fetch_month(url, slots, known=None):
+    size, etag = remote_metadata(url)
+    if known is not None and size is not None and size == known['source_size'] \
+            and (etag is None or known['source_etag'] is None or etag == known['source_etag']):
+        return UNCHANGED
+
+    ## Caps how many downloaded files can sit on disk waiting for the writer
+    slots.acquire()
+    try:
+        with instrument.span('download', target=url.split('/')[-1]) as s:
+            entry = download_file_with_retries(url, DOWNLOAD_DIR)
+            if entry is not None:
+                s['bytes_read'] = entry['bytes_transferred']
+                s['from_cache'] = entry['from_cache']
+        if entry is None:
+            slots.release()
+            return None
+        ## Objects are named by their sha256, so the checksum comes for free
+        return {
+            'path': entry['path'],
+            'source_size': entry['size'],
+            'source_etag': entry['etag'] or etag,
+            'checksum': entry['sha256'],
+        }
+    except Exception:
+        slots.release()
+        raise
+
+def create_manifest(con):
+    con.execute("""
+        CREATE TABLE IF NOT EXISTS load_manifest (
+            color VARCHAR,
+            year INTEGER,
+            month INTEGER,
+            source_url VARCHAR,
+            source_size BIGINT,
+            source_etag VARCHAR,
+            checksum VARCHAR,
+            row_count BIGINT,
+            loaded_at TIMESTAMP,
+            PRIMARY KEY (color, year, month)
+        )
+    """)
+
+def read_manifest(con, color):
+    rows = con.execute("""
+        SELECT year, month, source_size, source_etag, checksum
+        FROM load_manifest WHERE color = ?
+    """, [color]).fetchall()
+    return {
+        (year, month): {'source_size': size, 'source_etag': etag, 'checksum': checksum}
+        for year, month, size, etag, checksum in rows
+    }
+
+def table_type(con, name):
+    row = con.execute(
+        "SELECT table_type FROM information_schema.tables WHERE table_name = ?", [name]
+    ).fetchone()
+    return row[0] if row else None
+
+def table_exists(con, name):
+    return table_type(con, name) is not None
+
+def ensure_table(con, color, storage_mode=STORAGE_MODE):
+    schema.create_enum_types(con)
+    current_type = table_type(con, color)
+    raw_view = schema.lake_view(color)
+    ## In lake mode the raw rows are the view raw_view, and the color view reads the cleaned
+    ## dataset clean.py writes. Older lake databases had the raw view under the color name.
+    has_raw_view = table_type(con, raw_view) == 'VIEW'
+    was_lake = current_type == 'VIEW' or has_raw_view
+    if current_type == 'VIEW' and not has_raw_view:
+        con.execute(f"DROP VIEW {color}")
+        current_type = None
+
+    if storage_mode == 'lake':
+        if current_type == 'BASE TABLE' and not was_lake:
+            ## Switching from table storage, every month has to be written to the lake
+            logger.warning(f"Table '{color}' is being replaced by the Parquet lake, reloading all months.")
+            con.execute(f"DROP TABLE {color}")
+            con.execute("DELETE FROM load_manifest WHERE color = ?", [color])
+        return
+
+    if was_lake:
+        logger.warning(f"Parquet lake for '{color}' is being replaced by a table, reloading all months.")
+        con.execute(f"DROP VIEW IF EXISTS {raw_view}")
+        if current_type is not None:
+            con.execute(f"DROP {'VIEW' if current_type == 'VIEW' else 'TABLE'} {color}")
+        con.execute("DELETE FROM load_manifest WHERE color = ?", [color])
+        current_type = None
+
+    expected = [name.lower() for name, _ in schema.INGEST_SCHEMA[color] + schema.LOAD_COLUMNS]
+    if current_type is not None:
+        current = [row[0].lower() for row in con.execute(f"DESCRIBE {color}").fetchall()]
+        if current == expected:
+            return
+        ## Table was built by an older loader with a different layout, rebuild it from scratch
+        logger.warning(f"Table '{color}' does not match the ingest schema, reloading all months.")
+        con.execute(f"DROP TABLE {color}")
+        con.execute("DELETE FROM load_manifest WHERE color = ?", [color])
+    logger.info(f"Creating table '{color}' from the declared ingest schema.")
+    con.execute(schema.table_ddl(color))
+
+def lake_partition_dir(color, year, month):
+    return os.path.join(LAKE_DIR, color, f"year={year}", f"month={month}")
+
+def register_lake_view(con, color):
+    if not os.path.isdir(os.path.join(LAKE_DIR, color)):
+        logger.warning(f"No lake partitions for {color} yet, view not created.")
+        return
+    con.execute(schema.lake_view_sql(color, LAKE_DIR))
+    logger.info(f"Registered view '{schema.lake_view(color)}' over {LAKE_DIR}/{color}, "
+                f"clean.py writes {LAKE_DIR}/{schema.clean_lake_dir(color)}")
+
+def write_month_to_lake(con, color, year, month, url, fetched, projection):
+    local_file_path = fetched['path']
+    partition_dir = lake_partition_dir(color, year, month)
+    os.makedirs(partition_dir, exist_ok=True)
+    final_path = os.path.join(partition_dir, "data.parquet")
+    tmp_path = os.path.join(partition_dir, ".data.parquet.tmp")
+
+    ## Written under a hidden name and renamed into place, readers only ever see whole files
+    row_count = instrument.execute(con, f"""
+        COPY (
+            SELECT
+                {projection}
+            FROM read_parquet('{local_file_path}')
+        ) TO '{tmp_path}' (FORMAT parquet, COMPRESSION zstd)
+    """, fetch="fetchone")[0]
+    os.replace(tmp_path, final_path)
+    con.execute("""
+        INSERT OR REPLACE INTO load_manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, current_timestamp)
+    """, [color, year, month, url, fetched['source_size'], fetched['source_etag'],
+          fetched['checksum'], row_count])
+    return row_count
+
+def replace_month(con, color, year, month, url, fetched, storage_mode=STORAGE_MODE):
+    local_file_path = fetched['path']
+    source_columns = [row[0] for row in con.execute(
+        f"DESCRIBE SELECT * FROM read_parquet('{local_file_path}')"
+    ).fetchall()]
+    projection = schema.select_list(color, source_columns)
+    if storage_mode == 'lake':
+        return write_month_to_lake(con, color, year, month, url, fetched, projection)
+
+    ## The month's rows and its manifest entry change together or not at all, so an
+    ## interrupted run never leaves a half-loaded or duplicated month behind
+    con.execute("BEGIN TRANSACTION")
+    try:
+        instrument.execute(con, f"DELETE FROM {color} WHERE source_year = ? AND source_month = ?", [year, month])
+        instrument.execute(con, f"""
+            INSERT INTO {color}
+            SELECT
+                {projection},
+                {year} AS source_year,
+                {month} AS source_month
+            FROM read_parquet('{local_file_path}')
+        """)
+        row_count = instrument.execute(
+            con, f"SELECT COUNT(*) FROM {color} WHERE source_year = ? AND source_month = ?", [year, month],
+            fetch="fetchone"
+        )[0]
+        con.execute("""
+            INSERT OR REPLACE INTO load_manifest VALUES (?, ?, ?, ?, ?, ?, ?, ?, current_timestamp)
+        """, [color, year, month, url, fetched['source_size'], fetched['source_etag'],
+              fetched['checksum'], row_count])
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return row_count
+
+def process_data_for_color(con, color, years, months, max_workers=DOWNLOAD_WORKERS, full_refresh=FULL_REFRESH,
+                           storage_mode=STORAGE_MODE):
 
     logger.info(f"--- Starting processing for {color} taxi data ---")
-    
-    con.execute(f"DROP TABLE IF EXISTS {color};")
-    logger.info(f"Dropped table '{color}' if it existed.")
 
-    first_file_loaded = False
-    base_url = "https://d37ci6vzurychx.cloudfront.net/trip-data"
+    create_manifest(con)
+    if full_refresh:
+        if table_type(con, color) == 'VIEW':
+            con.execute(f"DROP VIEW {color};")
+        con.execute(f"DROP VIEW IF EXISTS {schema.lake_view(color)};")
+        con.execute(f"DROP TABLE IF EXISTS {color};")
+        con.execute("DELETE FROM load_manifest WHERE color = ?", [color])
+        for dataset in (color, schema.clean_lake_dir(color)):
+            if os.path.isdir(os.path.join(LAKE_DIR, dataset)):
+                shutil.rmtree(os.path.join(LAKE_DIR, dataset))
+        logger.info(f"Full refresh: dropped '{color}', its lake partitions and its manifest entries.")
+    ensure_table(con, color, storage_mode)
 
-    ## Loop through each month and each year for data requests and save to temp file to uplaad
-    for year in years:
-        for month in months:
-            url = f"{base_url}/{color}_tripdata_{year}-{month}.parquet"
+    manifest = read_manifest(con, color)
+    logger.info(f"Manifest has {len(manifest)} months already loaded for {color}")
+
+    ## Downloads run in a bounded thread pool while this thread is the only DuckDB writer,
+    ## so network transfer for later months overlaps with the INSERT of earlier ones
+    slots = threading.BoundedSemaphore(max_workers * 2)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for year in years:
+            for month in months:
+                url = f"{BASE_URL}/{color}_tripdata_{year}-{month}.parquet"
+                known = manifest.get((year, int(month)))
+                futures[pool.submit(fetch_month, url, slots, known)] = (year, month, url)
+
+        for future in as_completed(futures):
+            year, month, url = futures[future]
             logger.info(f"Processing {color} data for {year}-{month}")
 
-            local_file_path = download_file_with_retries(url, DOWNLOAD_DIR)
+            try:
+                fetched = future.result()
+            except Exception as e:
+                logger.error(f"Download worker failed for {color} {year}-{month}: {e}")
+                continue
 
-            if local_file_path is None:
+            if fetched is None:
                 logger.warning(f"File for {color} {year}-{month} does not exist...")
                 continue
-            
+            if fetched == UNCHANGED:
+                logger.info(f"Skipping {color} {year}-{month}, unchanged since last load.")
+                continue
+
+            local_file_path = fetched['path']
             try:
-                if not first_file_loaded:
-                    sql = f"CREATE TABLE {color} AS SELECT * FROM read_parquet('{local_file_path}');"
-                    logger.info(f"Creating table '{color}' with data from {year}-{month}.")
-                    first_file_loaded = True
-                else:
-                    sql = f"INSERT INTO {color} SELECT * FROM read_parquet('{local_file_path}');"
-                
-                con.execute(sql)
-                logger.info(f"Successfully loaded {month}-{year} into '{color}' table.")
+                known = manifest.get((year, int(month)))
+                if known is not None and known['checksum'] == fetched['checksum']:
+                    logger.info(f"Skipping {color} {year}-{month}, checksum matches manifest.")
+                    continue
+                with instrument.span('insert', target=f"{color} {year}-{month}") as s:
+                    s['bytes_read'] = fetched['source_size']
+                    s['rows_in'] = con.execute(
+                        f"SELECT SUM(num_rows) FROM parquet_file_metadata('{local_file_path}')"
+                    ).fetchone()[0]
+                    row_count = replace_month(con, color, year, int(month), url, fetched, storage_mode)
+                    s['rows_out'] = row_count
+                logger.info(f"Successfully loaded {row_count} rows for {month}-{year} into '{color}' table.")
 
             except Exception as e:
                 logger.error(f"DuckDB error while processing {local_file_path}: {e}")
             finally:
-                if os.path.exists(local_file_path):
-                    os.remove(local_file_path)
-                    logger.info(f"Removed local file for {color}: {year}-{month}")
+                ## The file stays in the download cache, it only becomes evictable once loaded
+                download_cache.unpin(DOWNLOAD_DIR, local_file_path)
+                download_cache.evict(DOWNLOAD_DIR, DOWNLOAD_CACHE_MAX_BYTES)
+                slots.release()
+
+    if storage_mode == 'lake':
+        register_lake_view(con, color)
 
     logger.info(f"Finished processing for {color} taxi data")
 
+def load_emissions(con):
+    con.execute(f"""
+                DROP TABLE IF EXISTS emissions
+            """)
+
+    try:
+        logger.info("Loading emissions data")
+        with instrument.span('load_emissions', target='emissions'):
+            instrument.execute(con, f"""
+                    CREATE TABLE emissions AS SELECT * FROM read_csv('{schema.EMISSIONS_FILE}')
+                """)
+            ## Which emissions row each fleet uses, and the trip rules built on it
+            schema.create_trip_definitions(con)
+
+
+    except Exception as e:
+        logger.error(f"Error loading emission data")
+    finally:
+        logger.info("Success")
+
 def load_parquet_files():
     con = None
     try:
-        con = duckdb.connect(database=DB_FILE, read_only=False)
+        con = connection.connect(DB_FILE, bulk=True)
         logger.info(f"Connected to DuckDB database: '{DB_FILE}'")
+        instrument.start_run('load')
 
         ## List of values to iterate through for years and months
         years = [2015, 2016, 2017, 2018, 2019, 2020, 2021, 2022, 2023, 2024]
         months = [f"{m:02d}" for m in range(1, 13)] # Generates ['01', '02', ..., '12']
 
-        process_data_for_color(con, 'yellow', years, months)
-        process_data_for_color(con, 'green', years, months)
-
-        con.execute(f"""
-                    DROP TABLE IF EXISTS emissions
-                """)
+        for color in FLEETS:
+            with instrument.span('load_fleet', target=color):
+                process_data_for_color(con, color, years, months)
 
-        try:
-            logger.info("Loading emissions data")
-            con.execute(f"""
-                        CREATE TABLE emissions AS SELECT * FROM read_csv('data/vehicle_emissions.csv')
-                    """)
-
-
-        except Exception as e:
-            logger.error(f"Error loading emission data")
-        finally:
-            logger.info("Success")
-        
-        ## Remove temp download dir
-        os.rmdir(DOWNLOAD_DIR)
-
-        yellow_count = con.execute(f"""
-                    SELECT COUNT(*) FROM yellow;
-                """)
+        load_emissions(con)
 
-        green_count = con.execute(f"""
-                    SELECT COUNT(*) FROM green;
-                """)
+        for color in FLEETS:
+            months_loaded, row_count = con.execute("""
+                        SELECT COUNT(*), COALESCE(SUM(row_count), 0) FROM load_manifest WHERE color = ?
+                    """, [color]).fetchone()
+            logger.info(f"Raw {color} rows: {row_count} across {months_loaded} months")
+        return True
 
     except Exception as e:
         logger.critical(f"A critical error occurred in the main script: {e}")
+        return False
     finally:
         if con:
+            instrument.flush(con)
             con.close()
             logger.info("DuckDB connection closed.")
 
 
 if __name__ == "__main__":
-    load_parquet_files()
\ No newline at end of file
+    if not load_parquet_files():
+        sys.exit(1)
\ No newline at end of file
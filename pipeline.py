@@ -0,0 +1,314 @@
+import argparse
+import duckdb
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from pathlib import Path
+
+import clean
+import connection
+import instrument
+import load
+import result_cache
+import schema
+
+## Importing load configured logging for load.log, this run logs to its own file instead
+logging.basicConfig(
+    level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+    filename='pipeline.log', force=True
+)
+logger = logging.getLogger(__name__)
+
+## Single entry point for the whole pipeline. Stages form a dependency graph:
+##
+##   load:yellow -> clean:yellow --\
+##                                  merge -> dbt -> analysis
+##   load:green  -> clean:green  --/
+##
+## Each fleet loads and cleans into its own staging database in separate worker processes,
+## so the two branches run side by side. merge attaches the staging files and copies the
+## cleaned tables into the main database for dbt. A stage is skipped when its code and the
+## outputs of the stages it depends on are the same as on its last successful run.
+
+REPO = Path(__file__).resolve().parent
+DB_FILE = os.environ.get("DB_FILE", "traffic.duckdb")
+STAGING_DIR = os.environ.get("STAGING_DIR", "staging") # One DuckDB file per fleet
+STATE_FILE = os.environ.get("PIPELINE_STATE", ".pipeline_state.json") # Fingerprints of the last successful runs
+PIPELINE_WORKERS = int(os.environ.get("PIPELINE_WORKERS", os.cpu_count() or 2)) # Stages run at the same time
+FLEETS = ("yellow", "green")
+LOG_TABLES = ["dq_report", "stage_metrics", "query_profile"] # Run logs appended to the main database on merge
+## dbt and analysis.py read and write dbt/output under the repo wherever the pipeline is started
+DBT_DIR = REPO / "dbt"
+OUTPUT_PLOT = str(DBT_DIR / "output" / "co2_by_month.png")
+
+
+def staging_db(fleet):
+    return os.path.join(STAGING_DIR, f"{fleet}.duckdb")
+
+def script(name, env, cwd=None):
+    def run():
+        return subprocess.run([sys.executable, str(REPO / name)], env=dict(os.environ, **env), cwd=cwd).returncode == 0
+    return run
+
+def run_dbt():
+    output = DBT_DIR / "output"
+    os.makedirs(output, exist_ok=True)
+    ## trips_export is rewritten on every run in whichever format the dbt vars ask for. Exports
+    ## left from an earlier run go first, a stale format or month directory is never read.
+    for stale in (output / "trips.parquet", output / "trips.csv"):
+        stale.unlink(missing_ok=True)
+    shutil.rmtree(output / "trips", ignore_errors=True)
+    return subprocess.run(
+        ["dbt", "run", "--project-dir", str(DBT_DIR), "--profiles-dir", str(DBT_DIR)],
+        cwd=DBT_DIR, env=dict(os.environ, DUCKDB_PATH=os.path.abspath(DB_FILE)),
+    ).returncode == 0
+
+def manifest_fingerprint(db_file):
+    ## What a load produced: the checksum of every month in the staging manifest, and where
+    ## it wrote them. Switching STORAGE_MODE reloads the raw rows, so they need cleaning again.
+    try:
+        with connection.connect(db_file, read_only=True) as con:
+            rows = con.execute("SELECT color, year, month, checksum FROM load_manifest ORDER BY ALL").fetchall()
+    except duckdb.Error:
+        return None
+    return result_cache.make_key(load.STORAGE_MODE, rows)
+
+def dbt_files():
+    files = [DBT_DIR / "dbt_project.yml"]
+    for folder in ("models", "macros"):
+        files += sorted((DBT_DIR / folder).rglob("*"))
+    return [str(f.relative_to(REPO)) for f in files if f.is_file()]
+
+def build_graph(workers=PIPELINE_WORKERS):
+    graph = {}
+    ## Fleet branches run side by side, each sizes DuckDB for its share of the host
+    branches = max(1, min(workers, len(FLEETS)))
+    for fleet in FLEETS:
+        env = {"DB_FILE": staging_db(fleet), "FLEETS": fleet, "DUCKDB_PROCESSES": str(branches)}
+        graph[f"load:{fleet}"] = {
+            'deps': [],
+            'run': script("load.py", env),
+            'code': ["load.py", "schema.py", "download_cache.py", "connection.py", "instrument.py"],
+            ## The remote files can change at any time, load itself skips unchanged months
+            'always': True,
+            'fingerprint': lambda db=staging_db(fleet): manifest_fingerprint(db),
+        }
+        graph[f"clean:{fleet}"] = {
+            'deps': [f"load:{fleet}"],
+            'run': script("clean.py", env),
+            'code': ["clean.py", "dq.py", "schema.py", "connection.py", "instrument.py"],
+            'outputs': [staging_db(fleet)],
+        }
+    graph["merge"] = {
+        'deps': [f"clean:{fleet}" for fleet in FLEETS],
+        'run': merge,
+        ## merge reloads the emissions table, so a new factor in the CSV re-runs it and dbt
+        'code': ["pipeline.py", "clean.py", "schema.py", "connection.py", "instrument.py",
+                 "data/vehicle_emissions.csv"],
+        'outputs': [DB_FILE],
+    }
+    graph["dbt"] = {
+        'deps': ["merge"],
+        'run': run_dbt,
+        'code': dbt_files(),
+        'outputs': [DB_FILE],
+    }
+    graph["analysis"] = {
+        'deps': ["dbt"],
+        ## Run from the repo so analysis.py's dbt/output paths point at what dbt just wrote
+        'run': script("analysis.py", {"DB_FILE": os.path.abspath(DB_FILE)}, cwd=REPO),
+        'code': ["analysis.py", "result_cache.py", "connection.py", "instrument.py"],
+        'outputs': [OUTPUT_PLOT],
+    }
+    return graph
+
+def stage_key(name, stage, outputs):
+    code = {f: hashlib.sha256((REPO / f).read_bytes()).hexdigest() for f in stage['code']}
+    return result_cache.make_key(name, code, [outputs.get(dep) for dep in stage['deps']])
+
+def read_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def write_state(state):
+    tmp = f"{STATE_FILE}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, STATE_FILE)
+
+def is_current(stage, key, previous):
+    if stage.get('always') or previous is None or previous['key'] != key:
+        return False
+    return all(os.path.exists(p) for p in stage.get('outputs', []))
+
+def run_stage(name, stage, key):
+    with instrument.span('stage', target=name) as s:
+        logger.info(f"{name}: starting")
+        ok = stage['run']()
+        s['ok'] = ok
+    if not ok:
+        logger.error(f"{name}: failed")
+        return 'failed', None
+    output = stage['fingerprint']() if 'fingerprint' in stage else key
+    logger.info(f"{name}: finished")
+    return 'ok', output
+
+def merge_log_table(con, alias, table):
+    exists = con.execute(
+        "SELECT COUNT(*) FROM duckdb_tables() WHERE database_name = ? AND table_name = ?", [alias, table]
+    ).fetchone()[0]
+    if not exists:
+        return
+    instrument.execute(con, f"CREATE TABLE IF NOT EXISTS {table} AS SELECT * FROM {alias}.{table} LIMIT 0")
+    instrument.execute(con, f"""
+        INSERT INTO {table}
+        SELECT * FROM {alias}.{table}
+        WHERE run_id NOT IN (SELECT DISTINCT run_id FROM {table})
+    """)
+
+def merge(db_file=DB_FILE):
+    """Copies every fleet's cleaned table, manifest rows and run logs from staging into db_file.
+
+    In lake storage mode the cleaned rows stay in their Parquet dataset and db_file gets a view over it.
+    """
+    con = None
+    try:
+        ## Not a bulk connection: the copy has to keep the staging row order, which is
+        ## clustered by pickup time
+        con = connection.connect(db_file)
+        schema.create_enum_types(con)
+        load.create_manifest(con)
+        clean.create_clean_manifest(con)
+        for fleet in FLEETS:
+            alias = f"{fleet}_stage"
+            con.execute(f"ATTACH '{staging_db(fleet)}' AS {alias} (READ_ONLY)")
+            try:
+                with instrument.span('merge_fleet', target=fleet) as s:
+                    ## Readers see either the previous tables or the merged ones, never a mix
+                    con.execute("BEGIN TRANSACTION")
+                    try:
+                        views = {row[0] for row in con.execute(
+                            "SELECT database_name FROM duckdb_views() WHERE view_name = ? AND database_name IN (current_database(), ?)",
+                            [fleet, alias]).fetchall()}
+                        if views - {alias}:
+                            instrument.execute(con, f"DROP VIEW {fleet}")
+                        instrument.execute(con, f"DROP TABLE IF EXISTS {fleet}")
+                        if alias in views:
+                            instrument.execute(con, schema.clean_lake_view_sql(fleet, load.LAKE_DIR))
+                            merged = instrument.execute(con, f"SELECT COUNT(*) FROM {fleet}", fetch="fetchone")[0]
+                        else:
+                            instrument.execute(con, schema.table_ddl(fleet))
+                            merged = instrument.execute(
+                                con, f"INSERT INTO {fleet} SELECT * FROM {alias}.{fleet}", fetch="fetchone"
+                            )[0]
+                        s['rows_out'] = merged
+                        instrument.execute(con, "DELETE FROM load_manifest WHERE color = ?", [fleet])
+                        instrument.execute(
+                            con, f"INSERT INTO load_manifest SELECT * FROM {alias}.load_manifest WHERE color = ?", [fleet]
+                        )
+                        ## Carries cleaned_at over as is, so dbt only rebuilds months clean changed
+                        instrument.execute(con, "DELETE FROM clean_manifest WHERE color = ?", [fleet])
+                        instrument.execute(
+                            con, f"INSERT INTO clean_manifest SELECT * FROM {alias}.clean_manifest WHERE color = ?", [fleet]
+                        )
+                        for table in LOG_TABLES:
+                            merge_log_table(con, alias, table)
+                        con.execute("COMMIT")
+                    except Exception:
+                        con.execute("ROLLBACK")
+                        raise
+                logger.info(f"Merged {merged} {fleet} rows from {staging_db(fleet)}")
+            finally:
+                con.execute(f"DETACH {alias}")
+        load.load_emissions(con)
+        return True
+    except Exception as e:
+        logger.critical(f"Merge failed: {e}")
+        return False
+    finally:
+        if con:
+            con.close()
+
+def run_pipeline(only=None, force=False, dry_run=False, workers=PIPELINE_WORKERS):
+    os.makedirs(STAGING_DIR, exist_ok=True)
+    graph = build_graph(workers)
+    state = read_state()
+    selected = [name for name in graph if only is None or name in only]
+    ## Stages left out of this run count with the output they had last time
+    outputs = {name: entry['output'] for name, entry in state.items()}
+    results = {}
+
+    if dry_run:
+        for name in selected:
+            key = stage_key(name, graph[name], outputs)
+            current = not force and is_current(graph[name], key, state.get(name))
+            print(f"{name:15} {'skip (unchanged)' if current else 'run'}")
+        return True
+
+    instrument.start_run('pipeline')
+    pending = list(selected)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                deps = [dep for dep in graph[name]['deps'] if dep in selected]
+                if any(results[dep][0] in ('failed', 'upstream failed') for dep in deps if dep in results):
+                    results[name] = ('upstream failed', None)
+                    pending.remove(name)
+                    continue
+                if not all(dep in results for dep in deps):
+                    continue
+                pending.remove(name)
+                key = stage_key(name, graph[name], outputs)
+                if not force and is_current(graph[name], key, state.get(name)):
+                    logger.info(f"{name}: inputs unchanged, skipping")
+                    results[name] = ('skipped', state[name]['output'])
+                    continue
+                running[pool.submit(run_stage, name, graph[name], key)] = (name, key)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                results[name] = future.result()
+                if results[name][0] == 'ok':
+                    outputs[name] = results[name][1]
+                    state[name] = {'key': key, 'output': outputs[name],
+                                   'finished_at': datetime.now().isoformat(timespec='seconds')}
+                    write_state(state)
+
+    for name in selected:
+        print(f"{name:15} {results[name][0]}")
+    if os.path.exists(DB_FILE):
+        try:
+            with connection.connect(DB_FILE) as con:
+                instrument.flush(con)
+        except duckdb.Error as e:
+            logger.warning(f"Could not write metrics to {DB_FILE} ({e})")
+    return all(status in ('ok', 'skipped') for status, _ in results.values())
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the taxi CO2 pipeline as a dependency graph")
+    parser.add_argument("--only", help="comma separated stages, e.g. load:green,clean:green (default: all)")
+    parser.add_argument("--force", action="store_true", help="run stages even when their inputs are unchanged")
+    parser.add_argument("--dry-run", action="store_true", help="show which stages would run and exit")
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS, help="stages run at the same time")
+    args = parser.parse_args()
+
+    only = args.only.split(",") if args.only else None
+    unknown = set(only or []) - set(build_graph())
+    if unknown:
+        parser.error(f"unknown stages: {unknown}")
+    if not run_pipeline(only, args.force, args.dry_run, args.workers):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
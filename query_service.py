@@ -0,0 +1,221 @@
+import argparse
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import duckdb
+import pandas as pd
+
+import connection
+import trips_query
+
+logger = logging.getLogger(__name__)
+
+## Long-running HTTP/JSON service for CO2 statistics, so dashboards don't re-run analysis.py
+## per question. It keeps a pool of read-only cursors on one DuckDB database and answers
+## from the clustered cleaned tables through trips_query, with recent answers kept in
+## memory for SERVICE_CACHE_TTL seconds. DuckDB lets either one writing process or any
+## number of read-only ones open a file, so stop the service while the pipeline runs.
+## In lake storage mode --lake serves the cleaned Parquet datasets instead and never opens
+## the database file, so it can keep running through pipeline runs.
+##
+##   GET /health
+##   GET /co2/groups?fleet=yellow&group=hour_of_day&start=2024-01-01&end=2024-02-01
+##   GET /co2/totals?fleet=green&start=2024-01-01&end=2025-01-01&grain=month
+##   GET /co2/largest?fleet=yellow&start=2024-01-01&end=2024-02-01&pickup=132,138
+##
+## Every /co2 endpoint takes fleet, start and end (YYYY-MM-DD, end exclusive) and optional
+## comma separated pickup= and dropoff= zone IDs.
+
+DB_FILE = os.environ.get("DB_FILE", "traffic.duckdb")
+SERVICE_PORT = int(os.environ.get("SERVICE_PORT", 8080))
+SERVICE_POOL_SIZE = int(os.environ.get("SERVICE_POOL_SIZE", 4)) # Queries that can run at the same time
+SERVICE_CACHE_TTL = float(os.environ.get("SERVICE_CACHE_TTL", 300)) # Seconds an answer is reused
+SERVICE_CACHE_ENTRIES = int(os.environ.get("SERVICE_CACHE_ENTRIES", 1024))
+POOL_TIMEOUT = 30 # Seconds a request waits for a free connection before failing
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire ttl seconds after they were stored."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+def open_pool(db_file, size, lake_dir=None):
+    """Queue of cursors on one read-only connection, they share the database instance and its buffer cache.
+
+    With lake_dir the connection reads that directory's cleaned datasets instead of db_file.
+    """
+    con = trips_query.open_lake(lake_dir) if lake_dir else connection.connect(db_file, read_only=True)
+    pool = queue.Queue()
+    for _ in range(size):
+        pool.put(con.cursor())
+    return con, pool
+
+@contextmanager
+def borrow(pool):
+    try:
+        cur = pool.get(timeout=POOL_TIMEOUT)
+    except queue.Empty:
+        raise TimeoutError(f"No free connection after {POOL_TIMEOUT}s")
+    try:
+        yield cur
+    finally:
+        pool.put(cur)
+
+def _ids(params, name):
+    raw = params.get(name)
+    if not raw:
+        return None
+    try:
+        return sorted({int(v) for v in raw.split(",") if v})
+    except ValueError:
+        raise ValueError(f"{name} must be comma separated zone IDs")
+
+def parse_filters(params):
+    """fleet, start, end and location filters from query parameters, as trips_query arguments."""
+    for name in ("fleet", "start", "end"):
+        if not params.get(name):
+            raise ValueError(f"Missing parameter {name}")
+    try:
+        start, end = date.fromisoformat(params["start"]), date.fromisoformat(params["end"])
+    except ValueError:
+        raise ValueError("start and end must be dates, YYYY-MM-DD")
+    if end <= start:
+        raise ValueError("end must be after start")
+    return {'fleet': params["fleet"], 'start': start, 'end': end,
+            'pickup_locations': _ids(params, "pickup"), 'dropoff_locations': _ids(params, "dropoff")}
+
+def _records(df):
+    ## NaN isn't valid JSON (sums over a range with no trips are NaN), send null instead
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+def answer(cur, path, params):
+    """Runs the query behind one endpoint and returns a JSON-ready result."""
+    filters = parse_filters(params)
+    if path == "/co2/groups":
+        df = trips_query.co2_by_group(cur, group=params.get("group", "hour_of_day"), **filters)
+    elif path == "/co2/totals":
+        df = trips_query.co2_between(cur, grain=params.get("grain"), **filters)
+    else:
+        trip = trips_query.largest_trip(cur, **filters)
+        return trip and {k: None if pd.isna(v) else v for k, v in trip.items()}
+    return _records(df)
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    con = None
+    pool = None
+    cache = None
+    routes = ("/co2/groups", "/co2/totals", "/co2/largest")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, status, body):
+        data = json.dumps(body, default=str, allow_nan=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        started = time.perf_counter()
+        url = urlparse(self.path)
+        if url.path == "/health":
+            return self.send_json(HTTPStatus.OK, {'status': 'ok'})
+        if url.path not in self.routes:
+            return self.send_json(HTTPStatus.NOT_FOUND, {'error': f"Unknown endpoint {url.path}"})
+
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        key = (url.path, tuple(sorted(params.items())))
+        ## Entries are wrapped in a tuple so an empty answer (None) can be cached too
+        hit = self.cache.get(key)
+        cached = hit is not None
+        try:
+            if cached:
+                result, = hit
+            else:
+                with borrow(self.pool) as cur:
+                    result = answer(cur, url.path, params)
+                self.cache.put(key, (result,))
+        except ValueError as e:
+            return self.send_json(HTTPStatus.BAD_REQUEST, {'error': str(e)})
+        except TimeoutError as e:
+            return self.send_json(HTTPStatus.SERVICE_UNAVAILABLE, {'error': str(e)})
+        except duckdb.Error as e:
+            logger.error(f"{self.path} failed: {e}")
+            return self.send_json(HTTPStatus.INTERNAL_SERVER_ERROR, {'error': str(e)})
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"{self.path} {'cached' if cached else 'queried'} in {elapsed_ms:.1f} ms")
+        self.send_json(HTTPStatus.OK, {'result': result, 'cached': cached, 'elapsed_ms': round(elapsed_ms, 3)})
+
+def start(db_file=DB_FILE, port=0, pool_size=SERVICE_POOL_SIZE, ttl=SERVICE_CACHE_TTL,
+          max_entries=SERVICE_CACHE_ENTRIES, lake_dir=None):
+    """Serves db_file, or lake_dir's datasets, in a background thread, returns (server, base_url).
+
+    server.shutdown() stops it.
+    """
+    con, pool = open_pool(db_file, pool_size, lake_dir)
+    handler = type("Handler", (ServiceHandler,), {"con": con, "pool": pool, "cache": TTLCache(ttl, max_entries)})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    logger.info(f"Serving CO2 queries on {lake_dir or db_file} at {base_url} with {pool_size} connections")
+    return server, base_url
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+        filename='query_service.log'
+    )
+    parser = argparse.ArgumentParser(description="Serve CO2 statistics over HTTP/JSON")
+    parser.add_argument("--db", default=DB_FILE)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--pool-size", type=int, default=SERVICE_POOL_SIZE)
+    parser.add_argument("--lake", nargs="?", const=trips_query.LAKE_DIR, metavar="DIR",
+                        help=f"serve the cleaned lake datasets in DIR (default {trips_query.LAKE_DIR}) instead of --db")
+    args = parser.parse_args()
+    lake_dir = os.path.abspath(args.lake) if args.lake else None
+    server, base_url = start(args.db, args.port, args.pool_size, lake_dir=lake_dir)
+    print(f"Serving CO2 queries at {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
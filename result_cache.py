@@ -0,0 +1,54 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+## Small on-disk cache: each entry is a directory named by its key holding one file per
+## artifact. Entries are touched on every hit and the least recently used are evicted
+## once the cache grows past its size or entry cap.
+
+
+def make_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def get(cache_dir, key):
+    entry = Path(cache_dir) / key
+    if not (entry / ".complete").exists():
+        return None
+    artifacts = {p.name: p.read_bytes() for p in entry.iterdir() if p.name != ".complete"}
+    now = time.time()
+    os.utime(entry, (now, now))
+    return artifacts
+
+def put(cache_dir, key, artifacts, max_bytes, max_entries):
+    cache_dir = Path(cache_dir)
+    entry = cache_dir / key
+    tmp = cache_dir / f".{key}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    for name, data in artifacts.items():
+        (tmp / name).write_bytes(data)
+    ## The marker is written last, a half-written entry is never returned by get()
+    (tmp / ".complete").touch()
+    shutil.rmtree(entry, ignore_errors=True)
+    tmp.rename(entry)
+    evict(cache_dir, max_bytes, max_entries)
+
+def evict(cache_dir, max_bytes, max_entries):
+    entries = []
+    for entry in Path(cache_dir).iterdir():
+        if entry.is_dir() and not entry.name.startswith("."):
+            size = sum(p.stat().st_size for p in entry.iterdir())
+            entries.append((entry.stat().st_mtime, size, entry))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    while entries and (total > max_bytes or len(entries) > max_entries):
+        _, size, entry = entries.pop(0)
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        logger.info(f"Evicted cache entry {entry.name}")
@@ -0,0 +1,155 @@
+import os
+
+## Declared ingest schema for each fleet. Only these columns are loaded from the TLC
+## Parquet files, and each one is cast to a compact type. Columns are matched by name
+## (case-insensitive) so files from different years with extra, missing or renamed
+## columns (e.g. airport_fee vs Airport_fee) still load into the same table.
+
+ENUM_TYPES = {
+    'store_and_fwd_flag_t': ['Y', 'N'],
+    'payment_type_t': ['Flex Fare', 'Credit card', 'Cash', 'No charge', 'Dispute', 'Unknown', 'Voided trip'],
+}
+
+MONEY = 'DECIMAL(9, 2)'
+
+## Expression templates used to convert a raw column, {col} is the quoted source column.
+## payment_type arrives as the TLC code 0-6 and is mapped onto its label by position.
+CASTS = {
+    'store_and_fwd_flag_t': "TRY_CAST(UPPER(TRIM(CAST({col} AS VARCHAR))) AS store_and_fwd_flag_t)",
+    'payment_type_t': "TRY_CAST([" + ", ".join(f"'{v}'" for v in ENUM_TYPES['payment_type_t'])
+                      + "][TRY_CAST({col} AS INTEGER) + 1] AS payment_type_t)",
+}
+
+def _trip_columns(prefix):
+    return [
+        ('VendorID', 'UTINYINT'),
+        (f'{prefix}_pickup_datetime', 'TIMESTAMP'),
+        (f'{prefix}_dropoff_datetime', 'TIMESTAMP'),
+        ('passenger_count', 'UTINYINT'),
+        ('trip_distance', 'DOUBLE'),
+        ('RatecodeID', 'UTINYINT'),
+        ('store_and_fwd_flag', 'store_and_fwd_flag_t'),
+        ('PULocationID', 'USMALLINT'),
+        ('DOLocationID', 'USMALLINT'),
+        ('payment_type', 'payment_type_t'),
+        ('fare_amount', MONEY),
+        ('tip_amount', MONEY),
+        ('total_amount', MONEY),
+        ('congestion_surcharge', MONEY),
+    ]
+
+## Fleet-specific pickup/dropoff column names, everything else is shared
+TIME_COLUMNS = {
+    'yellow': ('tpep_pickup_datetime', 'tpep_dropoff_datetime'),
+    'green': ('lpep_pickup_datetime', 'lpep_dropoff_datetime'),
+}
+
+INGEST_SCHEMA = {
+    'yellow': _trip_columns('tpep') + [('airport_fee', MONEY)],
+    'green': _trip_columns('lpep'),
+}
+
+## Each fleet's row in the emissions data. load.py writes it to the fleets table, which the
+## dbt models and trips_query join on, so the mapping only lives here
+VEHICLE_TYPES = {
+    'yellow': 'yellow_taxi',
+    'green': 'green_taxi',
+}
+
+## Trip rules shared by the dbt trips model and trips_query, stored in the database as macros
+TRIP_MACROS = {
+    'is_valid_trip(distance, pickup, dropoff)': "distance > 0 AND DATE_DIFF('minute', pickup, dropoff) > 0",
+    'trip_co2_kgs(distance, grams_per_mile)': "distance * grams_per_mile / 1000.0",
+}
+
+## Emission factor per vehicle type, read by load.py and by lake-mode readers
+EMISSIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "vehicle_emissions.csv")
+
+## Added by the loader to every row, identifies the monthly file it came from
+LOAD_COLUMNS = [
+    ('source_year', 'SMALLINT'),
+    ('source_month', 'TINYINT'),
+]
+
+
+def create_enum_types(con):
+    for name, values in ENUM_TYPES.items():
+        exists = con.execute(
+            "SELECT COUNT(*) FROM duckdb_types() WHERE type_name = ?", [name]
+        ).fetchone()[0]
+        if not exists:
+            labels = ", ".join(f"'{v}'" for v in values)
+            con.execute(f"CREATE TYPE {name} AS ENUM ({labels})")
+
+def create_trip_definitions(con):
+    """Creates the fleets table and the trip macros, replacing any older version."""
+    con.execute("CREATE OR REPLACE TABLE fleets (fleet VARCHAR PRIMARY KEY, vehicle_type VARCHAR)")
+    con.executemany("INSERT INTO fleets VALUES (?, ?)", list(VEHICLE_TYPES.items()))
+    for signature, body in TRIP_MACROS.items():
+        con.execute(f"CREATE OR REPLACE MACRO {signature} AS {body}")
+
+def table_ddl(color):
+    columns = INGEST_SCHEMA[color] + LOAD_COLUMNS
+    body = ",\n    ".join(f"{name} {sql_type}" for name, sql_type in columns)
+    return f"CREATE TABLE {color} (\n    {body}\n)"
+
+def column_names(color):
+    return [name for name, _ in INGEST_SCHEMA[color]]
+
+def select_list(color, source_columns):
+    """Builds the projection that maps one file's columns onto the declared schema."""
+    available = {c.lower(): c for c in source_columns}
+    exprs = []
+    for name, sql_type in INGEST_SCHEMA[color]:
+        source = available.get(name.lower())
+        if source is None:
+            exprs.append(f"CAST(NULL AS {sql_type}) AS {name}")
+            continue
+        col = f'"{source}"'
+        template = CASTS.get(sql_type, "TRY_CAST({col} AS " + sql_type + ")")
+        exprs.append(f"{template.format(col=col)} AS {name}")
+    return ",\n    ".join(exprs)
+
+def lake_view(color):
+    """Name of the raw view over a fleet's lake partitions. clean.py writes the cleaned rows to
+    their own dataset, clean_lake_dir(color), and the color view reads that."""
+    return f"{color}_raw"
+
+def clean_lake_dir(color):
+    return f"{color}_clean"
+
+def clean_lake_files(color, lake_path):
+    """Glob over every file of a fleet's cleaned dataset."""
+    return f"{lake_path}/{clean_lake_dir(color)}/*/*/*.parquet"
+
+def _lake_columns(color):
+    exprs = []
+    for name, sql_type in INGEST_SCHEMA[color]:
+        if sql_type in ENUM_TYPES:
+            ## Parquet stores ENUMs as strings, restore the type so both backends match
+            exprs.append(f"CAST({name} AS {sql_type}) AS {name}")
+        else:
+            exprs.append(name)
+    return exprs
+
+def lake_view_sql(color, lake_path):
+    """View over the year=/month= Parquet dataset that exposes the same columns as the table."""
+    exprs = _lake_columns(color) + ["CAST(year AS SMALLINT) AS source_year", "CAST(month AS TINYINT) AS source_month"]
+    body = ",\n    ".join(exprs)
+    return f"""CREATE OR REPLACE VIEW {lake_view(color)} AS
+SELECT
+    {body}
+FROM read_parquet('{lake_path}/{color}/*/*/*.parquet', hive_partitioning = true)"""
+
+def clean_lake_view_sql(color, lake_path):
+    """View named color over the cleaned dataset: the table's columns plus pickup_partition.
+
+    The cleaned dataset is partitioned by pickup month. A filter on pickup_partition with
+    constant bounds lets DuckDB skip every file outside them.
+    """
+    exprs = _lake_columns(color) + ["source_year", "source_month", "make_date(year, month, 1) AS pickup_partition"]
+    body = ",\n    ".join(exprs)
+    return f"""CREATE OR REPLACE VIEW {color} AS
+SELECT
+    {body}
+FROM read_parquet('{clean_lake_files(color, lake_path)}', hive_partitioning = true)"""
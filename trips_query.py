@@ -0,0 +1,199 @@
+import argparse
+import logging
+import os
+from datetime import date, timedelta
+
+import connection
+import instrument
+import schema
+
+logger = logging.getLogger(__name__)
+
+## Date-range CO2 aggregates straight from the cleaned yellow/green tables. clean.py writes
+## those tables sorted by pickup time, so each row group covers a narrow time range and
+## DuckDB's per-row-group min/max (zone maps) lets the pickup range filter skip every row
+## group outside the range. A one-week query only reads the row groups of that week.
+## In lake storage mode the fleets are views over year=/month= Parquet datasets, and the
+## range also becomes a constant pickup_partition filter, so only that month's files are
+## opened. --lake reads those datasets without opening DB_FILE, and its lock, at all.
+
+DB_FILE = os.environ.get("DB_FILE", "traffic.duckdb")
+LAKE_DIR = os.path.abspath(os.environ.get("LAKE_DIR", "lake")) # Same as load.py and clean.py
+GRAINS = ("hour", "day", "week", "month")
+## The trips model's time features, computed the same way from the pickup column
+GROUP_PARTS = {'hour_of_day': 'hour', 'day_of_week': 'dayofweek', 'week_of_year': 'week', 'month_of_year': 'month'}
+
+
+def _check(fleet, grain=None, group=None):
+    if fleet not in schema.TIME_COLUMNS:
+        raise ValueError(f"Unknown fleet {fleet!r}, expected one of {sorted(schema.TIME_COLUMNS)}")
+    if grain is not None and grain not in GRAINS:
+        raise ValueError(f"Unknown grain {grain!r}, expected one of {GRAINS}")
+    if group is not None and group not in GROUP_PARTS:
+        raise ValueError(f"Unknown group {group!r}, expected one of {tuple(GROUP_PARTS)}")
+
+def open_lake(lake_dir=LAKE_DIR):
+    """In-memory connection with the fleet views over lake_dir's cleaned datasets and the emissions CSV."""
+    con = connection.connect()
+    schema.create_enum_types(con)
+    schema.create_trip_definitions(con)
+    for fleet in schema.TIME_COLUMNS:
+        if os.path.isdir(os.path.join(lake_dir, schema.clean_lake_dir(fleet))):
+            con.execute(schema.clean_lake_view_sql(fleet, lake_dir))
+    con.execute(f"CREATE VIEW emissions AS SELECT * FROM read_csv('{schema.EMISSIONS_FILE}')")
+    return con
+
+def is_lake(con, fleet):
+    """True when fleet is a view over a cleaned lake dataset rather than a table."""
+    return con.execute("""
+        SELECT COUNT(*) FROM duckdb_columns()
+        WHERE database_name = current_database() AND table_name = ? AND column_name = 'pickup_partition'
+    """, [fleet]).fetchone()[0] > 0
+
+def _trips(con, fleet, start, end, pickup_locations=None, dropoff_locations=None):
+    """FROM/WHERE over one fleet's trips in [start, end) with their CO2, and its parameters.
+
+    Uses the same trip filter and emission factor as the dbt trips model, through the fleets
+    table and the is_valid_trip macro.
+    """
+    pickup, dropoff = schema.TIME_COLUMNS[fleet]
+    ## The range is a plain comparison on the raw pickup column, wrapping the column in a
+    ## function would stop DuckDB from checking it against the zone maps
+    sql = f"""
+        FROM {fleet},
+            (SELECT co2_grams_per_mile FROM emissions JOIN fleets USING (vehicle_type) WHERE fleet = ?) f
+        WHERE {pickup} >= ? AND {pickup} < ?
+          AND is_valid_trip(trip_distance, {pickup}, {dropoff})"""
+    params = [fleet, start, end]
+    if is_lake(con, fleet):
+        ## DuckDB only skips files for constant bounds on the partition columns
+        sql += "\n          AND pickup_partition >= ? AND pickup_partition < ?"
+        params += [date(start.year, start.month, 1), end]
+    if pickup_locations:
+        sql += "\n          AND PULocationID IN (SELECT unnest(?))"
+        params.append(list(pickup_locations))
+    if dropoff_locations:
+        sql += "\n          AND DOLocationID IN (SELECT unnest(?))"
+        params.append(list(dropoff_locations))
+    return sql, params
+
+def co2_between(con, fleet, start, end, grain=None, pickup_locations=None, dropoff_locations=None):
+    """Trips, miles and CO2 for fleet trips picked up in [start, end), one row per grain bucket.
+
+    Without a grain the result is a single row for the whole range. Location filters are
+    lists of TLC zone IDs.
+    """
+    _check(fleet, grain)
+    pickup, _ = schema.TIME_COLUMNS[fleet]
+    bucket = f"DATE_TRUNC('{grain}', {pickup})" if grain else "CAST(? AS TIMESTAMP)"
+    trips, params = _trips(con, fleet, start, end, pickup_locations, dropoff_locations)
+    return instrument.execute(con, f"""
+        SELECT
+            {bucket} AS period_start,
+            COUNT(*) AS trip_count,
+            SUM(trip_distance) AS distance_miles,
+            trip_co2_kgs(SUM(trip_distance), ANY_VALUE(f.co2_grams_per_mile)) AS co2_kgs,
+            trip_co2_kgs(AVG(trip_distance), ANY_VALUE(f.co2_grams_per_mile)) AS avg_trip_co2_kgs
+        {trips}
+        GROUP BY ALL
+        ORDER BY period_start
+    """, ([] if grain else [start]) + params, fetch="df")
+
+def co2_by_group(con, fleet, start, end, group, pickup_locations=None, dropoff_locations=None):
+    """Trip count, average and total trip CO2 per hour_of_day, day_of_week, week_of_year or month_of_year.
+
+    The SQL counterpart of analysis.avg_by_group, restricted to a date range and locations.
+    """
+    _check(fleet, group=group)
+    pickup, _ = schema.TIME_COLUMNS[fleet]
+    trips, params = _trips(con, fleet, start, end, pickup_locations, dropoff_locations)
+    return instrument.execute(con, f"""
+        SELECT
+            CAST(EXTRACT({GROUP_PARTS[group]} FROM {pickup}) AS TINYINT) AS {group},
+            COUNT(*) AS trip_count,
+            trip_co2_kgs(AVG(trip_distance), ANY_VALUE(f.co2_grams_per_mile)) AS avg_trip_co2_kgs,
+            trip_co2_kgs(SUM(trip_distance), ANY_VALUE(f.co2_grams_per_mile)) AS co2_kgs
+        {trips}
+        GROUP BY ALL
+        ORDER BY {group}
+    """, params, fetch="df")
+
+def largest_trip(con, fleet, start, end, pickup_locations=None, dropoff_locations=None):
+    """The trip with the most CO2 in the range as a dict, or None when there are no trips."""
+    _check(fleet)
+    pickup, dropoff = schema.TIME_COLUMNS[fleet]
+    trips, params = _trips(con, fleet, start, end, pickup_locations, dropoff_locations)
+    df = instrument.execute(con, f"""
+        SELECT
+            {pickup} AS pickup_datetime,
+            {dropoff} AS dropoff_datetime,
+            PULocationID,
+            DOLocationID,
+            trip_distance,
+            trip_co2_kgs(trip_distance, f.co2_grams_per_mile) AS trip_co2_kgs,
+            DATE_DIFF('minute', {pickup}, {dropoff}) AS duration_minutes
+        {trips}
+        ORDER BY trip_co2_kgs DESC
+        LIMIT 1
+    """, params, fetch="df")
+    return df.iloc[0].to_dict() if len(df) else None
+
+def row_groups_touched(con, fleet, start, end, lake_dir=LAKE_DIR):
+    """(row groups whose pickup min/max overlaps [start, end), total row groups) for fleet."""
+    _check(fleet)
+    pickup, _ = schema.TIME_COLUMNS[fleet]
+    if is_lake(con, fleet):
+        ## Lake row groups are Parquet row groups, their min/max are in the file footers
+        return instrument.execute(con, """
+            SELECT
+                COUNT(*) FILTER (WHERE CAST(stats_max_value AS TIMESTAMP) >= ? AND CAST(stats_min_value AS TIMESTAMP) < ?),
+                COUNT(*)
+            FROM parquet_metadata(?)
+            WHERE path_in_schema = ?
+        """, [start, end, schema.clean_lake_files(fleet, lake_dir), pickup], fetch="fetchone")
+    ## storage_info reports each column segment's zone map as text, "[Min: ..., Max: ...][Has Null: ...]"
+    return instrument.execute(con, """
+        WITH zone_maps AS (
+            SELECT
+                row_group_id,
+                MIN(TRY_CAST(regexp_extract(stats, 'Min: ([^,\\]]+)', 1) AS TIMESTAMP)) AS min_pickup,
+                MAX(TRY_CAST(regexp_extract(stats, 'Max: ([^,\\]]+)', 1) AS TIMESTAMP)) AS max_pickup
+            FROM pragma_storage_info(?)
+            WHERE column_name = ? AND segment_type <> 'VALIDITY'
+            GROUP BY row_group_id
+        )
+        SELECT
+            COUNT(*) FILTER (WHERE max_pickup >= ? AND min_pickup < ?),
+            COUNT(*)
+        FROM zone_maps
+    """, [fleet, pickup, start, end], fetch="fetchone")
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s',
+        filename='trips_query.log'
+    )
+    parser = argparse.ArgumentParser(description="CO2 aggregates for one fleet over a pickup date range")
+    parser.add_argument("--fleet", required=True, choices=sorted(schema.TIME_COLUMNS))
+    parser.add_argument("--start", required=True, type=date.fromisoformat, help="first pickup day, YYYY-MM-DD")
+    parser.add_argument("--end", type=date.fromisoformat, help="day after the last pickup day (default: start + 7 days)")
+    parser.add_argument("--grain", choices=GRAINS, help="one row per hour/day/week/month instead of a single total")
+    parser.add_argument("--db", default=DB_FILE)
+    parser.add_argument("--lake", nargs="?", const=LAKE_DIR, metavar="DIR",
+                        help=f"read the cleaned lake datasets in DIR (default {LAKE_DIR}) instead of --db")
+    args = parser.parse_args()
+    end = args.end or args.start + timedelta(days=7)
+
+    instrument.start_run('trips_query')
+    lake_dir = os.path.abspath(args.lake) if args.lake else LAKE_DIR
+    with (open_lake(lake_dir) if args.lake else connection.connect(args.db, read_only=True)) as con:
+        with instrument.span('query', target=args.fleet) as s:
+            result = co2_between(con, args.fleet, args.start, end, args.grain)
+            s['rows_out'] = len(result)
+        touched, total = row_groups_touched(con, args.fleet, args.start, end, lake_dir)
+    print(result.to_string(index=False))
+    print(f"\n{touched} of {total} row groups overlap {args.start} to {end}")
+    logger.info(f"{args.fleet} {args.start} to {end}: {touched} of {total} row groups overlap the range")
+
+if __name__ == "__main__":
+    main()